@@ -1,7 +1,7 @@
 import uuid
 from typing import List
 
-from model.chord import shift_to_standard_duration, shift_to_c_major_pitch, build_chord_names
+from model.chord import shift_to_standard_duration, shift_to_c_major_pitch, infer_chord_names
 from model.note import reverse_note_map, duration_map, Note, note_name_octave_to_pitch
 
 
@@ -60,7 +60,7 @@ def note_result_to_notes(note_result: List[dict], tempo: int, octave: int):
         pitches = [notes[pos['pos']] for pos in one_bar_note_pos]
         note_names = [reverse_note_map[pitch][0] for pitch in pitches]
         bar_note_names.append(note_names)
-    bar_chord_names = build_chord_names(bar_note_names)
+    bar_chord_names = infer_chord_names(bar_note_names)
 
     # now we can build the music with chord, appregio and melody
     start_time = 0
@@ -1,35 +1,68 @@
 import sys
 
-from model.arrangement import Arrangement
-from utils.utils import create_midi_file, read_note_from_sound_file, read_pitch_from_sound_file, save_midi_file, \
-    read_bpm_from_sound_file, get_heart_beat_track_and_save, normalize_bpm
+from model.arrangement import Arrangement, ArrangementVariant, arrangement_channel_map, PIANO, DRUM_LIGHT, \
+    DRUM_HEAVY
+from utils.cache import AnalysisCache
+from utils.utils import create_midi_file, save_midi_file, read_analysis_from_sound_file, \
+    get_heart_beat_track_and_save, normalize_bpm
 
-if len(sys.argv) < 3:
-    print('Usage: %s <filename> <destination>' % sys.argv[0])
-    sys.exit(1)
+FILLING_BARS = 2
+# wav skips the encoder entirely, mp3 and flac are streamed to ffmpeg
+HEARTBEAT_FORMAT = 'mp3'
+HEARTBEAT_FILENAME = 'heartbeat-01a.mp3'
 
-filename = sys.argv[1]
-destination = sys.argv[2]
+# other arrangements of the same analysis, name to a dict of level_map and layers, see ArrangementVariant
+STEM_VARIANT_SPECS = {
+    'melody': dict(layers=[PIANO]),
+    'no_drums': dict(layers=[layer for layer in arrangement_channel_map if layer not in (DRUM_LIGHT, DRUM_HEAVY)]),
+}
 
-midi_instance = create_midi_file(num_tracks=10, file_format=1)
 
-note_result = read_note_from_sound_file(filename)
-pitch_result = read_pitch_from_sound_file(filename)
-tempo = read_bpm_from_sound_file(filename)
-print('====> tempo extracted value = %d' % tempo)
-tempo = normalize_bpm(tempo)
-print('====> tempo shifted to value = %d' % tempo)
-emphasis_proportion_list = pitch_result['emphasis_proportion_list']
-density_level_list = pitch_result['density_level_list']
+def generate(filename: str, destination: str, variant_specs: dict = None):
+    """
+    build the arrangement midi file and the heartbeat track of one sound file
+    :param variant_specs: name to a dict of level_map and layers of each variant,
+                          written to destination_<name>.mid besides the full arrangement, the sound is analysed once
+    :return: a dict with the audio_duration of the sound file in second
+    """
+    variant_specs = {} if variant_specs is None else variant_specs
+    # the tracks are written to temporary files phrase by phrase instead of staying in memory,
+    # the analysis, the melody and the chords of the whole song still are, see Arrangement.iter_phrases
+    midi_instance = create_midi_file(num_tracks=10, file_format=1, streaming=True)
+    variants = [ArrangementVariant(midi_instance)] + \
+               [ArrangementVariant(create_midi_file(num_tracks=10, file_format=1, streaming=True), name=name, **spec)
+                for name, spec in variant_specs.items()]
 
-FILLING_BARS = 2
-arrangement = Arrangement(midi_instance=midi_instance, tempo=tempo, note_result=note_result,
-                          density_level_list=density_level_list, start_time=FILLING_BARS * 4)
-arrangement.build()
+    note_result, pitch_result, tempo = read_analysis_from_sound_file(filename, cache=AnalysisCache())
+    print('====> tempo extracted value = %d' % tempo)
+    tempo = normalize_bpm(tempo)
+    print('====> tempo shifted to value = %d' % tempo)
+    density_level_list = pitch_result['density_level_list']
+
+    arrangement = Arrangement(midi_instance=midi_instance, tempo=tempo, note_result=note_result,
+                              density_level_list=density_level_list, start_time=FILLING_BARS * 4, variants=variants)
+    for phrase in arrangement.iter_phrases():
+        # no note starts before the end of a finished phrase anymore
+        for variant in variants:
+            variant.midi_instance.flush(phrase['end_tick'])
+
+    print('====> generating heartbeat sound track')
+
+    get_heart_beat_track_and_save(filename=HEARTBEAT_FILENAME,
+                                  dest_filename=destination + '_heartbeat_track.' + HEARTBEAT_FORMAT,
+                                  bar_count=len(arrangement.melody.bar_note_result_list) + FILLING_BARS * 2,
+                                  bpm=tempo, output_format=HEARTBEAT_FORMAT)
+
+    save_midi_file(destination + '.mid', midi_instance)
+    for variant in variants[1:]:
+        save_midi_file('%s_%s.mid' % (destination, variant.name), variant.midi_instance)
+    pitch_track = pitch_result['pitch_result']
+    return dict(audio_duration=pitch_track[len(pitch_track) - 1]['time'])
 
-print('====> generating heartbeat sound track')
 
-get_heart_beat_track_and_save(filename='heartbeat-01a.mp3', dest_filename=destination + '_heartbeat_track.mp3',
-                              bar_count=len(arrangement.melody.bar_note_result_list) + FILLING_BARS * 2, bpm=tempo)
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: %s <filename> <destination> [stems]' % sys.argv[0])
+        sys.exit(1)
 
-save_midi_file(destination + '.mid', midi_instance)
+    generate(sys.argv[1], sys.argv[2], STEM_VARIANT_SPECS if sys.argv[3:] == ['stems'] else None)
@@ -1,12 +1,121 @@
+import multiprocessing
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
 from os import listdir
 from os.path import isfile, join
-from subprocess import call
+
+# imported once here, every worker is forked from this process with aubio, pydub and midiutil already loaded
+from arrangement_test import generate, HEARTBEAT_FILENAME
+from utils.heartbeat import heart_beat_sample_bank
 
 SOUND_PATH = './dataset'
-files = [f for f in listdir(SOUND_PATH) if isfile(join(SOUND_PATH, f))]
-for f in files:
-    if f.endswith('.m4a') is False:
-        continue
+RESULT_PATH = './dataset/result'
+DEFAULT_CONCURRENCY = multiprocessing.cpu_count()
+# in second
+DEFAULT_TIMEOUT = 30 * 60
+POLL_INTERVAL = 0.5
+
+
+def run_one(filename: str, destination: str, connection):
+    """
+    worker body, any exception is reported to the parent instead of being raised
+    """
+    try:
+        result = generate(filename, destination)
+        connection.send(dict(status='ok', audio_duration=result['audio_duration']))
+    except Exception:
+        connection.send(dict(status='error', error=traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def receive_result(receiver, process):
+    try:
+        if receiver.poll():
+            return receiver.recv()
+    except EOFError:
+        pass
+    # the worker died before sending anything
+    process.join()
+    return dict(status='crashed', error='exit code %s' % process.exitcode)
+
+
+def run_batch(jobs: list, concurrency: int = DEFAULT_CONCURRENCY, timeout: float = DEFAULT_TIMEOUT):
+    """
+    run generate for each (filename, destination) job in forked worker processes.
+    At most concurrency workers run at the same time, a worker running over timeout seconds is killed,
+    and a crashing worker only fails its own file.
+    :return: a list of dict of filename, status, wall_time, audio_duration and error
+    """
+    context = multiprocessing.get_context('fork')
+    # decoded once by ffmpeg here, the workers inherit the samples instead of decoding them again
+    heart_beat_sample_bank.get(HEARTBEAT_FILENAME)
+    pending = list(jobs)
+    running = {}
+    summary = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < concurrency:
+            filename, destination = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_one, args=(filename, destination, sender))
+            process.start()
+            sender.close()
+            running[process.sentinel] = dict(process=process, receiver=receiver, filename=filename,
+                                             start=time.time())
+
+        wait(list(running.keys()), timeout=POLL_INTERVAL)
+        now = time.time()
+        for sentinel, job in list(running.items()):
+            process = job['process']
+            wall_time = now - job['start']
+            if process.is_alive() and wall_time <= timeout:
+                continue
+            if process.is_alive():
+                process.terminate()
+                result = dict(status='timeout')
+            else:
+                result = receive_result(job['receiver'], process)
+            process.join()
+            job['receiver'].close()
+            del running[sentinel]
+            result.update(filename=job['filename'], wall_time=wall_time)
+            print('====> %s %s in %.1fs' % (job['filename'], result['status'], wall_time))
+            summary.append(result)
+    return summary
+
+
+def print_summary(summary: list):
+    print('====> batch summary')
+    for result in sorted(summary, key=lambda r: r['filename']):
+        audio_duration = result.get('audio_duration')
+        if audio_duration:
+            print('%-40s %-8s wall %8.1fs  audio %8.1fs  speed x%.1f' % (
+                result['filename'], result['status'], result['wall_time'], audio_duration,
+                audio_duration / max(result['wall_time'], 0.001)))
+        else:
+            print('%-40s %-8s wall %8.1fs' % (result['filename'], result['status'], result['wall_time']))
+        if 'error' in result:
+            print(result['error'])
+    total_wall_time = sum(result['wall_time'] for result in summary)
+    total_audio_duration = sum(result.get('audio_duration', 0) for result in summary)
+    failed = len([result for result in summary if result['status'] != 'ok'])
+    print('====> %d files, %d failed, %.1fs of audio, %.1fs of worker time' % (
+        len(summary), failed, total_audio_duration, total_wall_time))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        print('Usage: %s [concurrency] [timeout_in_second]' % sys.argv[0])
+        sys.exit(1)
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CONCURRENCY
+    timeout = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TIMEOUT
 
-    # $ python arrangement_test.py ./dataset/serpent.m4a ./dataset/result/serpent_
-    call(['python', 'arrangement_test.py', './dataset/%s' % f, './dataset/result/%s' % f.replace('.m4a', '')])
+    files = [f for f in listdir(SOUND_PATH) if isfile(join(SOUND_PATH, f))]
+    # ./dataset/serpent.m4a -> ./dataset/result/serpent
+    jobs = [(join(SOUND_PATH, f), join(RESULT_PATH, f.replace('.m4a', ''))) for f in sorted(files)
+            if f.endswith('.m4a')]
+    begin = time.time()
+    print_summary(run_batch(jobs, concurrency, timeout))
+    print('====> batch done in %.1fs' % (time.time() - begin))
@@ -0,0 +1,14 @@
+import sys
+
+from utils.cache import AnalysisCache
+
+if len(sys.argv) > 2:
+    print('Usage: %s [filename]' % sys.argv[0])
+    sys.exit(1)
+
+cache = AnalysisCache()
+if len(sys.argv) == 2:
+    removed = cache.invalidate(sys.argv[1])
+else:
+    removed = cache.invalidate()
+print('====> %d cache entries removed' % removed)
@@ -0,0 +1,70 @@
+import sys
+import time
+
+import numpy
+
+from model.pitch_track import PitchTrack
+from utils.utils import compute_density_from_pitch_result, compute_density_level, get_emphasis_start_times, \
+    compute_density_groups, compute_density_level_array, get_emphasis_ranges
+
+# the loop based functions are only measured up to this size
+MAX_LOOP_FRAMES = 1000000
+FRAME_SIZES = [10000, 100000, 1000000, 10000000]
+HOP_S = 512
+SAMPLE_RATE = 44100
+
+if len(sys.argv) > 2:
+    print('Usage: %s [max_frames]' % sys.argv[0])
+    sys.exit(1)
+max_frames = int(sys.argv[1]) if len(sys.argv) == 2 else FRAME_SIZES[-1]
+
+
+def random_pitch_track(frame_count: int, seed: int = 0):
+    """
+    alternate voiced and silent runs like a voice recording does
+    """
+    rng = numpy.random.RandomState(seed)
+    run_lengths = rng.geometric(0.05, size=frame_count // 10 + 2)
+    voiced_runs = numpy.arange(len(run_lengths)) % 2 == 0
+    voiced = numpy.repeat(voiced_runs, run_lengths)[:frame_count]
+    pitch = numpy.where(voiced, rng.uniform(40, 80, frame_count), rng.uniform(0, 0.5, frame_count))
+    frame_time = numpy.arange(frame_count) * HOP_S / float(SAMPLE_RATE)
+    return PitchTrack(frame_time, pitch, rng.uniform(0, 1, frame_count))
+
+
+def loop_analysis(track: PitchTrack):
+    length = track[len(track) - 1]['time']
+    groups = compute_density_from_pitch_result(track)
+    return compute_density_level(groups, length), get_emphasis_start_times(groups, length)
+
+
+def vectorized_analysis(track: PitchTrack):
+    length = track[len(track) - 1]['time']
+    group_starts, group_ends, log_densities = compute_density_groups(track)
+    levels, level_start_times = compute_density_level_array(track.time[group_starts], log_densities, length)
+    starts, ends = get_emphasis_ranges(track.time[group_starts], track.time[group_ends - 1], log_densities, length)
+    return ([dict(level=level, start_time=start_time) for level, start_time in
+             zip(levels.tolist(), level_start_times.tolist())],
+            [dict(start=start, end=end) for start, end in zip(starts.tolist(), ends.tolist())])
+
+
+for frame_count in FRAME_SIZES:
+    if frame_count > max_frames:
+        break
+    track = random_pitch_track(frame_count)
+
+    begin = time.time()
+    vectorized_result = vectorized_analysis(track)
+    vectorized_time = time.time() - begin
+
+    if frame_count > MAX_LOOP_FRAMES:
+        print('====> %d frames: vectorized %.3fs' % (frame_count, vectorized_time))
+        continue
+
+    begin = time.time()
+    loop_result = loop_analysis(track)
+    loop_time = time.time() - begin
+    if loop_result != vectorized_result:
+        print('====> %d frames: results differ' % frame_count)
+        sys.exit(1)
+    print('====> %d frames: loop %.3fs, vectorized %.3fs, same results' % (frame_count, loop_time, vectorized_time))
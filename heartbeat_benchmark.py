@@ -0,0 +1,85 @@
+import sys
+import time
+
+import numpy
+from pydub import AudioSegment
+
+from utils.heartbeat import heart_beat_sample_bank, render_heart_beat_track, heart_beat_offsets, \
+    audio_segment_to_array, HEART_BEAT_BAR_PATTERN, BEATS_OF_ONE_BAR
+from utils.utils import get_one_bar_heart_beat
+
+# compare the heartbeat track rendered at sample offsets with the AudioSegment concatenation it replaced.
+# The old track rounds every gap to whole milliseconds, so its beats drift a little bar after bar:
+# a beat may move by up to MAX_DRIFT_MS_PER_BAR from the previous one, and once aligned its samples
+# must match within MAX_SAMPLE_DIFF, the rounding of the gain.
+HEARTBEAT_FILENAME = 'heartbeat-01a.mp3'
+BPMS = [60, 90, 120, 143, 180]
+GAIN_DB = -3
+MAX_DRIFT_MS_PER_BAR = 1
+MAX_SAMPLE_DIFF = 1
+DEFAULT_BAR_COUNT = 64
+
+if len(sys.argv) > 2:
+    print('Usage: %s [bar_count]' % sys.argv[0])
+    sys.exit(1)
+bar_count = int(sys.argv[1]) if len(sys.argv) == 2 else DEFAULT_BAR_COUNT
+
+
+def segment_heart_beat_track(bpm: int):
+    """
+    the track as it was built before, bar by bar with AudioSegment
+    """
+    result = AudioSegment.empty()
+    for _ in range(bar_count):
+        result += get_one_bar_heart_beat(HEARTBEAT_FILENAME, bpm)
+    return result.apply_gain(GAIN_DB)
+
+
+def beat_shifts(old: numpy.ndarray, new: numpy.ndarray, offsets: numpy.ndarray, beat_lengths: list,
+                frame_rate: int):
+    """
+    :return: for each beat of new, the shift in frames of the same beat in old, None when it is not found
+    """
+    window = MAX_DRIFT_MS_PER_BAR * frame_rate // 1000
+    shift = 0
+    shifts = []
+    for offset, length in zip(offsets.ravel().tolist(), beat_lengths * len(offsets)):
+        beat = new[offset:offset + length]
+        found = None
+        # look near the shift of the previous beat first
+        for candidate in sorted(range(shift - window, shift + window + 1), key=lambda x: abs(x - shift)):
+            start = offset + candidate
+            if 0 <= start <= len(old) - length and numpy.abs(old[start:start + length] - beat).max() <= MAX_SAMPLE_DIFF:
+                found = candidate
+                break
+        shifts.append(found)
+        if found is not None:
+            shift = found
+    return shifts
+
+
+segments = heart_beat_sample_bank.get(HEARTBEAT_FILENAME)
+frame_rate = segments[0].frame_rate
+beat_lengths = [len(audio_segment_to_array(segments[beat])) for _, beat in HEART_BEAT_BAR_PATTERN]
+failed = False
+for bpm in BPMS:
+    begin = time.time()
+    old = audio_segment_to_array(segment_heart_beat_track(bpm))
+    old_time = time.time() - begin
+
+    begin = time.time()
+    rendered = render_heart_beat_track(HEARTBEAT_FILENAME, bar_count, bpm, gain_db=GAIN_DB)
+    new_time = time.time() - begin
+    new = rendered['samples'].astype(numpy.float32)
+
+    shifts = beat_shifts(old, new, heart_beat_offsets(bar_count, frame_rate * 60.0 / bpm), beat_lengths,
+                         frame_rate)
+    missing = sum(shift is None for shift in shifts)
+    max_shift = max([abs(shift) for shift in shifts if shift is not None] + [0])
+    expected_frames = int(round(bar_count * BEATS_OF_ONE_BAR * frame_rate * 60.0 / bpm))
+    print('====> %d bpm: segments %.3fs, rendered %.3fs, beats shifted by up to %d frames, '
+          'length %+d frames against the exact %d, %d beats not found' %
+          (bpm, old_time, new_time, max_shift, len(old) - expected_frames, expected_frames, missing))
+    failed = failed or missing > 0
+if failed:
+    sys.exit(1)
@@ -1,17 +1,23 @@
-from copy import copy
-from typing import List
+from typing import List, Iterable
 
+import numpy
 from midiutil import MIDIFile
 
 from model.channel import CHANNEL_NAME_DRUM_KIT, CHANNEL_NAME_PIANO, CHANNEL_NAME_ELECTRIC_PIANO, \
     CHANNEL_NAME_ENSEMBLE_STRING_1, CHANNEL_NAME_ENSEMBLE_STRING_2, CHANNEL_NAME_ACOUSTIC_GUITAR, \
     CHANNEL_NAME_FINGER_STYLE_BASS, CHANNEL_NAME_CHURCH_ORGAN, CHANNEL_NAME_ELECTRIC_GUITAR_CLEAN
+from model.layer import Layer, PhraseMemo, replay_phrase, replay_phrases, build_timeline, chord_bar_template, \
+    double_chord_bar_template, guitar_chord_bar_template, appregio_bar_template, root_note_bar_template, \
+    double_root_note_bar_template, drum_phrase_template
+from model.drum import DRUM_STYLE_BASIC
 from model.melody import Melody
-from model.note import volume_map, Note
-from model.phrase_2 import Phrase2
+from model.note import volume_map, Note, NoteArray, duration_map
+from model.phrase_2 import Phrase2, converge_octaves
+from model.tick import TICK_DTYPE, TICKS_OF_ONE_BAR, beats_to_ticks, ticks_to_beats
 from model.track import Track
 
 MAX_LEVEL = 10
+DEFAULT_LEVEL = 5
 PIANO = 'piano'
 PIANO_CHORD = 'piano_chord'
 STRING_CHORD = 'string_chord'
@@ -67,38 +73,173 @@ arrangement_channel_map = {
 }
 
 
-def accumulate_arrangement_level_map():
+# a layer is not played where one of these layers is
+arrangement_exclusion_map = {
+    DRUM_LIGHT: [DRUM_HEAVY],
+}
+
+
+def accumulate_arrangement_level_map(level_map: dict = arrangement_level_map):
+    """
+    each level also plays the instruments of the levels below it, level_map is changed in place
+    """
     for i in range(MAX_LEVEL):
         if i == 0:
             continue
-        arrangement_level_map[i].extend(arrangement_level_map[i - 1])
+        level_map[i].extend(level_map[i - 1])
+    return level_map
 
 
 accumulate_arrangement_level_map()
 
 
+class ArrangementVariant:
+    """
+    One rendering of an arrangement into its own midi file.
+    The levels given in level_map play their own instruments instead of those of arrangement_level_map,
+    see accumulate_arrangement_level_map to build it like the default one.
+    Only the instruments of layers are played, the melody being PIANO, all of them by default.
+    """
+
+    def __init__(self, midi_instance: MIDIFile, level_map: dict = None, layers: Iterable[str] = None,
+                 name: str = 'default'):
+        self.midi_instance = midi_instance
+        self.level_map = dict(arrangement_level_map)
+        if level_map is not None:
+            self.level_map.update(level_map)
+        self.layers = frozenset(arrangement_channel_map if layers is None else layers)
+        unknown_layers = self.layers.difference(arrangement_channel_map)
+        if len(unknown_layers) > 0:
+            raise Exception('unknown layers %s in variant %s' % (sorted(unknown_layers), name))
+        self.name = name
+        # created by the arrangement with its tempo
+        self.track_map = None
+
+    def __repr__(self):
+        return 'ArrangementVariant %s, layers = %s' % (self.name, sorted(self.layers))
+
+    def plays_melody(self):
+        return PIANO in self.layers
+
+    def instruments_of_level(self, level: int):
+        """
+        the enabled instruments of a level with a layer, in the order of arrangement_layer_map.
+        An instrument is only excluded by an enabled one, see arrangement_exclusion_map
+        """
+        instruments = [instrument for instrument in self.level_map[level] if instrument in self.layers]
+        return tuple(instrument for instrument in arrangement_layer_map if instrument in instruments and
+                     not any(other in instruments for other in arrangement_exclusion_map.get(instrument, [])))
+
+
 class Arrangement:
     """
     Given file parsing results, it will create necessary tracks, build melody and other instruments with level mapping.
     Define each track volume and add created notes to corresponding tracks.
     In a word, it do all the jobs...
+    The melody, the chords and the levels are computed once and rendered by every variant,
+    by default a single one writing every instrument to midi_instance.
     """
     MELODY_OCTAVE = 4
     BAR_OF_PHRASE = 2
     NOTE_OF_BAR = 4
 
     def __init__(self, midi_instance: MIDIFile, tempo: int, note_result: List[dict], density_level_list: List[dict],
-                 std_volume: int = volume_map['mf'], start_time: int = 0):
+                 std_volume: int = volume_map['mf'], start_time: int = 0, phrase_memo: PhraseMemo = None,
+                 variants: List[ArrangementVariant] = None, verbose: bool = False):
         self.midi_instance = midi_instance
         self.tempo = tempo
         self.note_result = note_result
         self.density_level_list = density_level_list
+        self.density_start_times = numpy.array([density_level['start_time'] for density_level in density_level_list],
+                                               dtype=numpy.float64)
+        self.density_levels = numpy.array([density_level['level'] for density_level in density_level_list],
+                                          dtype=numpy.int64)
         self.std_volume = std_volume
-        self.track_map = Track.create_track_map(midi_instance=midi_instance, tempo=tempo)
+        self.variants = [ArrangementVariant(midi_instance)] if variants is None else variants
+        if len(self.variants) == 0:
+            raise Exception('an arrangement needs at least one variant')
+        for variant in self.variants:
+            variant.track_map = Track.create_track_map(midi_instance=variant.midi_instance, tempo=tempo)
+        # the tracks of the first variant
+        self.track_map = self.variants[0].track_map
         self.melody = None
         self.start_time = start_time
+        # may be shared by arrangements and variants using the same layers, its keys hold the instruments
+        self.phrase_memo = PhraseMemo() if phrase_memo is None else phrase_memo
+        # print the level and the instruments of every phrase, besides the summary of each variant
+        self.verbose = verbose
+        self.__analysis = None
 
     def build(self):
+        """
+        add the notes of the whole song at once, to every variant
+        """
+        analysis = self.__analyse()
+        for variant in self.variants:
+            plan = self.__prepare(variant)
+            if variant.plays_melody():
+                variant.track_map[PIANO].add_note_array(analysis['melody_notes'])
+            # with defined levels, decide what instruments to add
+            for channel_name, entries in self.__channel_entries(plan['distinct_keys']).items():
+                notes = replay_phrases(entries, plan['phrase_entries'], analysis['phrase_ticks'])
+                if len(notes) > 0:
+                    variant.track_map[channel_name].add_note_array(notes)
+
+    def iter_phrases(self):
+        """
+        add the notes phrase by phrase, a phrase is yielded once all its notes are added to every variant
+        and no later note starts before its end_tick, so that streaming midi files can be flushed up to it.
+        Only the output is bounded by a phrase: the melody, the chords and the levels of the whole song
+        are computed before the first phrase, the level of a phrase depending on its position in the song.
+        Like note_result, they grow with the song length.
+        """
+        analysis = self.__analyse()
+        melody_notes = analysis['melody_notes']
+        melody_bounds = numpy.searchsorted(self.melody.note_bar // Arrangement.BAR_OF_PHRASE,
+                                           numpy.arange(len(analysis['levels']) + 1)).tolist()
+        plans = [self.__prepare(variant) for variant in self.variants]
+        channel_entries = [self.__channel_entries(plan['distinct_keys']) for plan in plans]
+        for i, level in enumerate(analysis['levels']):
+            start_tick = int(analysis['phrase_ticks'][i])
+            for variant, plan, entries_by_channel in zip(self.variants, plans, channel_entries):
+                if variant.plays_melody():
+                    variant.track_map[PIANO].add_note_array(melody_notes[melody_bounds[i]:melody_bounds[i + 1]])
+                entry_index = plan['phrase_entries'][i]
+                for channel_name, entries in entries_by_channel.items():
+                    if len(entries[entry_index]) > 0:
+                        variant.track_map[channel_name].add_note_array(replay_phrase(entries[entry_index],
+                                                                                     start_tick))
+            end_tick = start_tick + Arrangement.BAR_OF_PHRASE * TICKS_OF_ONE_BAR
+            yield dict(index=i, level=level, start_tick=start_tick, end_tick=end_tick,
+                       start_time=ticks_to_beats(start_tick), end_time=ticks_to_beats(end_tick))
+
+    def __prepare(self, variant: ArrangementVariant):
+        """
+        the accompaniment of the distinct phrases of a variant, the instruments of a phrase depending on its level
+        :return: a dict of distinct_keys and phrase_entries the index of the distinct key of each phrase
+        """
+        analysis = self.__analyse()
+        keys = []
+        for chord_names, level in zip(analysis['bars_of_chord'], analysis['levels']):
+            instruments = variant.instruments_of_level(level)
+            if self.verbose:
+                print('level = %d, instruments = %s' % (level, variant.level_map[level]))
+            keys.append((tuple(chord_names), instruments))
+        self.__memorize_accompaniments(keys)
+        distinct_keys = list(dict.fromkeys(keys))
+        print('====> variant %s: %d phrases, %d distinct, %s' % (variant.name, len(keys), len(distinct_keys),
+                                                                self.phrase_memo))
+        entry_index = {key: i for i, key in enumerate(distinct_keys)}
+        return dict(distinct_keys=distinct_keys,
+                    phrase_entries=numpy.array([entry_index[key] for key in keys], dtype=numpy.int64))
+
+    def __analyse(self):
+        """
+        build the melody, the chords and the level of every phrase, once for all the variants
+        :return: a dict of melody_notes, levels, phrase_ticks and bars_of_chord
+        """
+        if self.__analysis is not None:
+            return self.__analysis
         # build melody first
         melody = Melody(self.note_result, self.start_time).build()
         self.melody = melody
@@ -108,29 +249,50 @@ class Arrangement:
 
         sum_beat = len(melody.bar_note_result_list) * 4
         chunk_level_list = self.__compute_chunks_level(chunks, sum_beat)
-        begin_beat = copy(self.start_time)
-        for i, chunk in enumerate(chunks):
-            phrase = Phrase2(bars_of_notes=chunk, start_time=begin_beat)
-            bars_of_notes = phrase.standardize(std_octave=Arrangement.MELODY_OCTAVE).bars_of_notes
-            # melody first
-            for one_bar in bars_of_notes:
-                for note in one_bar:
-                    self.track_map[PIANO].add_note(note=note)
-
-            # with defined level, decide what instruments to add
-            self.__make_instruments_by_level(phrase=phrase, level=chunk_level_list[i])
-            begin_beat += Arrangement.NOTE_OF_BAR * Arrangement.BAR_OF_PHRASE
+        begin_tick = beats_to_ticks(self.start_time)
+        bars_of_chord = []
+        phrase_start_ticks = []
+        for chunk in chunks:
+            phrase = Phrase2(bars_of_notes=chunk, start_time=ticks_to_beats(begin_tick))
+            bars_of_chord.append(phrase.bars_of_chord)
+            phrase_start_ticks.append(begin_tick)
+            begin_tick += Arrangement.BAR_OF_PHRASE * TICKS_OF_ONE_BAR
+
+        # melody first, standardized phrase by phrase like Phrase2.standardize
+        melody_notes = melody.note_array.copy()
+        melody_notes['pitch'] = converge_octaves(melody_notes['pitch'], melody.note_bar // Arrangement.BAR_OF_PHRASE,
+                                                 len(chunks), Arrangement.MELODY_OCTAVE)
+
+        self.__analysis = dict(melody_notes=melody_notes, levels=chunk_level_list,
+                               phrase_ticks=numpy.array(phrase_start_ticks, dtype=TICK_DTYPE),
+                               bars_of_chord=bars_of_chord)
+        return self.__analysis
 
     def __compute_chunks_level(self, chunks: List[List[Note]], sum_beat: int):
         """
         A chunk is 4 bars of notes
         """
-        chunk_level_list = []
-        for chunk in chunks:
-            chunk_begin_time = chunk[0][0].time
-            level = self.__find_density_level(chunk_begin_time / sum_beat)
-            chunk_level_list.append(level)
-        return chunk_level_list
+        chunk_begin_times = numpy.array([chunk[0][0].time for chunk in chunks], dtype=numpy.float64)
+        return self.__find_density_levels(chunk_begin_times / sum_beat).tolist()
+
+    def __find_density_levels(self, relative_positions: numpy.ndarray):
+        """
+        level of the first density group i >= 1 such that start_time[i - 1] <= position <= start_time[i],
+        DEFAULT_LEVEL when there is none.
+        Start times are sorted, so that group is found by bisection.
+        """
+        start_times = self.density_start_times
+        if len(start_times) == 0:
+            return numpy.full(len(relative_positions), DEFAULT_LEVEL, dtype=numpy.int64)
+        if numpy.any(numpy.diff(start_times) < 0):
+            return numpy.array([self.__find_density_level(position) for position in relative_positions.tolist()],
+                               dtype=numpy.int64)
+        i = numpy.maximum(numpy.searchsorted(start_times, relative_positions, side='left'), 1)
+        found = i < len(start_times)
+        # any index in range where nothing is found
+        i = numpy.minimum(i, len(start_times) - 1)
+        found &= start_times[numpy.maximum(i - 1, 0)] <= relative_positions
+        return numpy.where(found, self.density_levels[i], DEFAULT_LEVEL)
 
     def __find_density_level(self, relative_position: float):
         for i, density_level in enumerate(self.density_level_list):
@@ -140,50 +302,78 @@ class Arrangement:
             current_density_level = self.density_level_list[i]
             if prev_density_level['start_time'] <= relative_position <= current_density_level['start_time']:
                 return density_level['level']
-        return 5
-
-    def __make_instruments_by_level(self, phrase: Phrase2, level: int):
-        instruments = arrangement_level_map[level]
-        print('level = %d, instruments = %s' % (level, instruments))
-        if PIANO_CHORD in instruments:
-            chords = phrase.build_double_chord(Arrangement.MELODY_OCTAVE - 1)
-            for chord in chords:
-                self.track_map[CHANNEL_NAME_ELECTRIC_PIANO].add_chord(chord=chord)
-        if STRING_CHORD in instruments:
-            chords = phrase.build_chords(Arrangement.MELODY_OCTAVE - 1, volume=volume_map['pp'])
-            for chord in chords:
-                self.track_map[CHANNEL_NAME_ENSEMBLE_STRING_1].add_chord(chord=chord)
-        if GUITAR_CHORD in instruments:
-            chords = phrase.build_guitar_chord(Arrangement.MELODY_OCTAVE - 1, volume=volume_map['ppp'])
-            for chord in chords:
-                self.track_map[CHANNEL_NAME_ACOUSTIC_GUITAR].add_chord(chord=chord)
-        if STRING_APPREGIO in instruments:
-            appregios = phrase.build_appregios(Arrangement.MELODY_OCTAVE, volume=volume_map['ppp'])
-            for appregio in appregios:
-                self.track_map[CHANNEL_NAME_ENSEMBLE_STRING_2].add_appregio(appregio=appregio)
-        if BASS in instruments:
-            root_notes = phrase.build_double_root_note(std_octave=Arrangement.MELODY_OCTAVE - 3,
-                                                       volume=volume_map['mf'])
-            for note in root_notes:
-                self.track_map[CHANNEL_NAME_FINGER_STYLE_BASS].add_note(note)
-        if DRUM_LIGHT in instruments and DRUM_HEAVY not in instruments:
-            drum_bar_notes = phrase.build_drum(volume=volume_map['p'])
-            for one_bar in drum_bar_notes:
-                for note in one_bar:
-                    self.track_map[CHANNEL_NAME_DRUM_KIT].add_note(note)
-        if PIANO_APPREGIO in instruments:
-            appregios = phrase.build_appregios(Arrangement.MELODY_OCTAVE, volume=volume_map['p'], style=2)
-            for appregio in appregios:
-                self.track_map[CHANNEL_NAME_ELECTRIC_PIANO].add_appregio(appregio)
-        if DRUM_HEAVY in instruments:
-            drum_bar_notes = phrase.build_drum(volume=volume_map['mf'])
-            for one_bar in drum_bar_notes:
-                for note in one_bar:
-                    self.track_map[CHANNEL_NAME_DRUM_KIT].add_note(note)
-        if ORGAN in instruments:
-            root_notes = phrase.build_root_note(std_octave=Arrangement.MELODY_OCTAVE + 1,
-                                                volume=volume_map['ppp'])
-            for note in root_notes:
-                self.track_map[CHANNEL_NAME_CHURCH_ORGAN].add_note(note)
-        if GUITAR_POWER_CHORD in instruments:
-            pass
+        return DEFAULT_LEVEL
+
+    def __memorize_accompaniments(self, keys: List[tuple]):
+        """
+        The accompaniment of each distinct phrase is built once, or found in the phrase memo,
+        then every phrase replays it from its start tick.
+        """
+        new_keys = list(dict.fromkeys(key for key in keys if key not in self.phrase_memo.entries))
+        self.phrase_memo.misses += len(new_keys)
+        self.phrase_memo.hits += len(keys) - len(new_keys)
+        for key, accompaniment in zip(new_keys, Arrangement.__build_accompaniments(new_keys)):
+            self.phrase_memo.entries[key] = accompaniment
+
+    def __channel_entries(self, distinct_keys: List[tuple]):
+        """
+        :return: by channel name, the relative notes of each distinct phrase
+        """
+        return {channel_name: [self.phrase_memo.entries[key].get(channel_name, NoteArray.create())
+                               for key in distinct_keys]
+                for channel_name in dict.fromkeys(layer.channel_name for layer in arrangement_layer_map.values())}
+
+    @staticmethod
+    def __build_accompaniments(keys: List[tuple]):
+        """
+        every layer builds its notes for all the given phrases at once, each phrase starting at 0.
+        The notes of a track are ordered by layer, as if they were added layer by layer.
+        :return: for each phrase key, a dict of NoteArray by channel name
+        """
+        accompaniments = [{} for _ in keys]
+        if len(keys) == 0:
+            return accompaniments
+        timeline = build_timeline([list(chord_names) for chord_names, _ in keys], [0] * len(keys))
+        track_layers = {}
+        for rank, (instrument, layer) in enumerate(arrangement_layer_map.items()):
+            enabled = numpy.array([instrument in instruments for _, instruments in keys], dtype=bool)
+            notes, phrases = layer.build(timeline, enabled)
+            if len(notes) > 0:
+                track_layers.setdefault(layer.channel_name, []).append((notes, phrases, rank))
+
+        for channel_name, layers in track_layers.items():
+            notes = numpy.concatenate([layer_notes for layer_notes, _, _ in layers])
+            phrases = numpy.concatenate([layer_phrases for _, layer_phrases, _ in layers])
+            ranks = numpy.concatenate([numpy.full(len(layer_notes), rank) for layer_notes, _, rank in layers])
+            order = numpy.lexsort((numpy.arange(len(notes)), ranks, phrases))
+            notes, phrases = notes[order], phrases[order]
+            bounds = numpy.searchsorted(phrases, numpy.arange(len(keys) + 1)).tolist()
+            for i, accompaniment in enumerate(accompaniments):
+                if bounds[i + 1] > bounds[i]:
+                    accompaniment[channel_name] = notes[bounds[i]:bounds[i + 1]]
+        return accompaniments
+
+
+# how each instrument of arrangement_level_map is played, in the order its notes are added
+arrangement_layer_map = {
+    PIANO_CHORD: Layer(CHANNEL_NAME_ELECTRIC_PIANO, volume_map['p'],
+                       lambda chord_name: double_chord_bar_template(chord_name, Arrangement.MELODY_OCTAVE - 1)),
+    STRING_CHORD: Layer(CHANNEL_NAME_ENSEMBLE_STRING_1, volume_map['pp'],
+                        lambda chord_name: chord_bar_template(chord_name, Arrangement.MELODY_OCTAVE - 1)),
+    GUITAR_CHORD: Layer(CHANNEL_NAME_ACOUSTIC_GUITAR, volume_map['ppp'],
+                        lambda chord_name: guitar_chord_bar_template(chord_name, Arrangement.MELODY_OCTAVE - 1)),
+    STRING_APPREGIO: Layer(CHANNEL_NAME_ENSEMBLE_STRING_2, volume_map['ppp'],
+                           lambda chord_name: appregio_bar_template(chord_name, Arrangement.MELODY_OCTAVE,
+                                                                    duration_map['quarter_note'])),
+    BASS: Layer(CHANNEL_NAME_FINGER_STYLE_BASS, volume_map['mf'],
+                lambda chord_name: double_root_note_bar_template(chord_name, Arrangement.MELODY_OCTAVE - 3)),
+    DRUM_LIGHT: Layer(CHANNEL_NAME_DRUM_KIT, volume_map['p'],
+                      lambda bar_count: drum_phrase_template(bar_count, DRUM_STYLE_BASIC), unit=Layer.PHRASE),
+    PIANO_APPREGIO: Layer(CHANNEL_NAME_ELECTRIC_PIANO, volume_map['p'],
+                          lambda chord_name: appregio_bar_template(chord_name, Arrangement.MELODY_OCTAVE,
+                                                                   duration_map['eighth_note'])),
+    DRUM_HEAVY: Layer(CHANNEL_NAME_DRUM_KIT, volume_map['mf'],
+                      lambda bar_count: drum_phrase_template(bar_count, DRUM_STYLE_BASIC), unit=Layer.PHRASE),
+    ORGAN: Layer(CHANNEL_NAME_CHURCH_ORGAN, volume_map['ppp'],
+                 lambda chord_name: root_note_bar_template(chord_name, Arrangement.MELODY_OCTAVE + 1)),
+}
@@ -1,7 +1,11 @@
 from copy import copy
+from functools import lru_cache
 
-from model.note import Note, note_name_octave_to_pitch, duration_map, c_major_pitch_list, standard_duration_list, \
-    volume_map, standard_volume_list
+import numpy
+
+from model.note import Note, NoteArray, note_name_octave_to_pitch, duration_map, c_major_pitch_list, \
+    standard_duration_list, volume_map, standard_volume_list, scale_volumes
+from model.tick import TICK_DTYPE, beats_to_ticks
 from typing import List
 
 
@@ -16,21 +20,13 @@ class Chord:
 
     @staticmethod
     def create_from_name_and_octave(chord_name: str, octave: int, time: int, duration: int, volume: int):
-        pitches = c_major_octave_chord(chord_name, octave)
-        notes = []
-        for pitch in pitches:
-            note = Note(pitch=pitch, time=time, duration=duration, volume=volume)
-            notes.append(note)
-        return Chord(notes)
+        template = note_template(chord_name, octave, CHORD_STYLE, duration)
+        return Chord(template_to_notes(template, time, volume))
 
     @staticmethod
     def create_guitar_chord_from_name_and_octave(chord_name: str, octave: int, time: int, duration: int, volume: int):
-        pitches = c_major_octave_guitar_chord(chord_name, octave)
-        notes = []
-        for pitch in pitches:
-            note = Note(pitch=pitch, time=time, duration=duration, volume=volume)
-            notes.append(note)
-        return Chord(notes)
+        template = note_template(chord_name, octave, GUITAR_CHORD_STYLE, duration)
+        return Chord(template_to_notes(template, time, volume))
 
 
 class Appregio:
@@ -48,35 +44,124 @@ class Appregio:
     @staticmethod
     def create(chord_name: str, octave: int, time: int, volume: int, beat_count: int = 4,
                note_duration: int = duration_map['quarter_note']):
-        pitches = c_major_octave_chord(chord_name, octave)
-        notes = []
-        start_time = copy(time)
-        extended_note_duration = copy(note_duration)
-        extended_note_duration *= 1.1
-        should_stop = False
-        i = 0
-        pitch_len = len(pitches)
-        while should_stop is not True:
-            # even number, forward
-            if (i // pitch_len) % 2 == 0:
-                for pitch in pitches:
-                    note = Note(pitch=pitch, time=start_time, duration=extended_note_duration, volume=volume)
-                    notes.append(note)
-                    start_time += note_duration
-                    i += 1
-                    if time + beat_count <= start_time:
-                        should_stop = True
-            else:
-                # odd number, backward
-                for pitch in reversed(pitches[0:len(pitches) -1]):
-                    note = Note(pitch=pitch, time=start_time, duration=extended_note_duration, volume=volume)
-                    notes.append(note)
-                    start_time += note_duration
-                    i += 1
-                    if time + beat_count <= start_time:
-                        should_stop = True
-
-        return Appregio(notes)
+        template = note_template(chord_name, octave, APPREGIO_STYLE, note_duration, beat_count)
+        return Appregio(template_to_notes(template, time, volume))
+
+
+# to sound better, an appregio note lasts 10% longer than its step
+APPREGIO_DURATION_PERCENT = 110
+
+
+@lru_cache(maxsize=None)
+def appregio_cycle(pitch_count: int):
+    """
+    pitch indexes of an appregio over pitch_count pitches until it repeats.
+    A pass goes forward through the chord when the number of notes before it divided by pitch_count is even,
+    else backward without the highest note. The passes have different lengths, so the cycle is
+    forward, backward, backward, then forward and backward pitch_count - 2 times: 2 * n * (n - 1) notes.
+    :return: read only arrays of the indexes of a cycle and of the note count at the end of each of its passes
+    """
+    if pitch_count < 2:
+        raise Exception('an appregio needs at least 2 pitches, got %d' % pitch_count)
+    forward = numpy.arange(pitch_count)
+    backward = numpy.arange(pitch_count - 2, -1, -1)
+    passes = [forward, backward, backward] + [forward, backward] * (pitch_count - 2)
+    indexes = numpy.concatenate(passes)
+    pass_ends = numpy.cumsum([len(one_pass) for one_pass in passes])
+    indexes.flags.writeable = False
+    pass_ends.flags.writeable = False
+    return indexes, pass_ends
+
+
+@lru_cache(maxsize=1024)
+def appregio_indexes(pitch_count: int, step_count: int):
+    """
+    pitch indexes of an appregio of at least step_count notes, it only stops at the end of a pass
+    """
+    cycle, pass_ends = appregio_cycle(pitch_count)
+    # the first note is always played
+    step_count = max(step_count, 1)
+    cycle_count = (step_count - 1) // len(cycle)
+    rest = step_count - cycle_count * len(cycle)
+    count = cycle_count * len(cycle) + int(pass_ends[numpy.searchsorted(pass_ends, rest)])
+    indexes = numpy.resize(cycle, count)
+    indexes.flags.writeable = False
+    return indexes
+
+
+def appregio_pattern(pitches: List[int], note_tick: int, beat_count: float):
+    """
+    pitches, ticks from 0 and duration ticks of an appregio, as arrays.
+    It goes forward through the chord then backward without its highest note, see appregio_cycle,
+    it only stops at the end of a pass once beat_count beats are filled.
+    """
+    if note_tick <= 0:
+        raise Exception('appregio notes must last at least one tick')
+    # ceil, the number of notes to fill beat_count beats
+    step_count = -(-beats_to_ticks(beat_count) // note_tick)
+    indexes = appregio_indexes(len(pitches), step_count)
+    extended_note_tick = note_tick * APPREGIO_DURATION_PERCENT // 100
+    return (numpy.asarray(pitches, dtype=numpy.int64)[indexes], numpy.arange(len(indexes)) * note_tick,
+            numpy.full(len(indexes), extended_note_tick))
+
+
+CHORD_STYLE = 'chord'
+GUITAR_CHORD_STYLE = 'guitar'
+APPREGIO_STYLE = 'appregio'
+
+
+@lru_cache(maxsize=1024)
+def note_template(chord_name: str, octave: int, style: str, note_duration: float, beat_count: int = 0):
+    """
+    notes of a chord, a guitar chord or an appregio starting at tick 0, computed once for the same arguments.
+    :param note_duration: duration of the chord, or of each appregio note, in beats
+    :param beat_count: length of an appregio, unused by chords
+    :return: a dict of read only pitch, tick and duration_tick arrays, and the notes as tuples
+    """
+    note_tick = beats_to_ticks(note_duration)
+    if style == APPREGIO_STYLE:
+        pitches, ticks, duration_ticks = appregio_pattern(c_major_octave_chord(chord_name, octave), note_tick,
+                                                          beat_count)
+    else:
+        if style == CHORD_STYLE:
+            pitches = c_major_octave_chord(chord_name, octave)
+        elif style == GUITAR_CHORD_STYLE:
+            pitches = c_major_octave_guitar_chord(chord_name, octave)
+        else:
+            raise Exception('unknown note template style %s' % style)
+        ticks = [0] * len(pitches)
+        duration_ticks = [note_tick] * len(pitches)
+    template = dict(pitch=numpy.array(pitches, dtype=numpy.int64), tick=numpy.array(ticks, dtype=TICK_DTYPE),
+                    duration_tick=numpy.array(duration_ticks, dtype=TICK_DTYPE))
+    for column in template.values():
+        column.flags.writeable = False
+    # the same as tuples, faster to turn into a few Note objects
+    template['notes'] = tuple(zip(template['pitch'].tolist(), template['tick'].tolist(),
+                                  template['duration_tick'].tolist()))
+    return template
+
+
+def template_to_notes(template: dict, time: float, volume: int):
+    tick = beats_to_ticks(time)
+    return [Note.from_ticks(pitch=pitch, tick=tick + note_tick, duration_tick=duration_tick, volume=volume)
+            for pitch, note_tick, duration_tick in template['notes']]
+
+
+def template_to_note_array(template: dict, ticks: numpy.ndarray, volume: int):
+    """
+    the template notes repeated at each of the given start ticks, in one NoteArray
+    :param volume: volume of the notes, scaled by the velocity percentages of the template if it has some
+    """
+    ticks = numpy.asarray(ticks, dtype=TICK_DTYPE)
+    result = NoteArray.create(len(ticks) * len(template['pitch']))
+    result['pitch'] = numpy.tile(template['pitch'], len(ticks))
+    result['tick'] = (ticks[:, None] + template['tick'][None, :]).ravel()
+    result['duration_tick'] = numpy.tile(template['duration_tick'], len(ticks))
+    if 'velocity' in template:
+        result['volume'] = numpy.tile(scale_volumes(volume, template['velocity']), len(ticks))
+    else:
+        result['volume'] = volume
+    return result
 
 
 major_progression = {
@@ -233,7 +318,41 @@ def is_previous_order(current: str, target: str):
     return False
 
 
+def find_approximate_in_sorted(values: numpy.ndarray, reference: List[float]):
+    """
+    nearest reference value of each value, the lower one when both are at the same distance.
+    :return: the nearest values and whether each value lies within the reference range
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    upper = numpy.clip(numpy.searchsorted(reference, values, side='left'), 1, len(reference) - 1)
+    lower_value = reference[upper - 1]
+    upper_value = reference[upper]
+    # the same comparison as the loops below, so that ties are broken the same way
+    result = numpy.where(values - lower_value <= upper_value - values, lower_value, upper_value)
+    valid = (values >= reference[0]) & (values <= reference[-1])
+    return result, valid
+
+
+def build_lookup_table(reference: List[int]):
+    """
+    nearest reference value of every midi value from 0 to 127, -1 when out of the reference range
+    """
+    result, valid = find_approximate_in_sorted(numpy.arange(128), reference)
+    return numpy.where(valid, result, -1).astype(numpy.int16)
+
+
+c_major_pitch_table = build_lookup_table(c_major_pitch_list)
+standard_volume_table = build_lookup_table(standard_volume_list)
+
+
+def is_midi_int(value):
+    return isinstance(value, (int, numpy.integer)) and not isinstance(value, bool) and 0 <= value < 128
+
+
 def find_approximate_c_major_pitch(given_pitch: int):
+    if is_midi_int(given_pitch) and c_major_pitch_table[given_pitch] >= 0:
+        return int(c_major_pitch_table[given_pitch])
     for j, c_major_pitch in enumerate(c_major_pitch_list):
         if c_major_pitch <= given_pitch and j + 1 < len(c_major_pitch_list) and c_major_pitch_list[
             j + 1] >= given_pitch:
@@ -266,6 +385,9 @@ def find_approximate_standard_duration(given_duration: float):
 
 
 def find_approximate_standard_volume(given_volume: int):
+    if is_midi_int(given_volume):
+        std_volume = standard_volume_table[given_volume]
+        return int(std_volume) if std_volume >= 0 else None
     for j, std_volume in enumerate(standard_volume_list):
         if std_volume <= given_volume and j + 1 < len(standard_volume_list) and standard_volume_list[
             j + 1] >= given_volume:
@@ -309,6 +431,53 @@ def shift_to_standard_duration(duration_list: List[float], fallback_duration: in
     return chosen_ones
 
 
+def lookup_or_search(values: numpy.ndarray, table: numpy.ndarray, reference: List[int]):
+    """
+    table lookup for integer values, search in the reference list for the others
+    :return: the nearest values as float64 and whether they were found
+    """
+    values = numpy.asarray(values)
+    if values.dtype.kind in 'iu':
+        in_table = (values >= 0) & (values < len(table))
+        found = numpy.full(values.shape, -1, dtype=numpy.int16)
+        found[in_table] = table[values[in_table]]
+        return found.astype(numpy.float64), found >= 0
+    return find_approximate_in_sorted(values, reference)
+
+
+def shift_to_c_major_pitch_array(pitches: numpy.ndarray):
+    """
+    vectorized shift_to_c_major_pitch, out of range pitches are kept
+    :return: an array of the same dtype as pitches
+    """
+    pitches = numpy.asarray(pitches)
+    result, valid = lookup_or_search(pitches, c_major_pitch_table, c_major_pitch_list)
+    if not valid.all():
+        print("Warning====> no suitable c major note for %d pitches" % numpy.count_nonzero(~valid))
+    return numpy.where(valid, result, pitches).astype(pitches.dtype)
+
+
+def shift_to_standard_volume_array(volumes: numpy.ndarray, fallback_volume: int = volume_map['f']):
+    """
+    vectorized shift_to_standard_volume
+    :return: an int64 array
+    """
+    result, valid = lookup_or_search(volumes, standard_volume_table, standard_volume_list)
+    return numpy.where(valid, result, fallback_volume).astype(numpy.int64)
+
+
+def shift_to_standard_duration_array(durations: numpy.ndarray,
+                                     fallback_duration: int = duration_map['quarter_note']):
+    """
+    vectorized shift_to_standard_duration, durations longer than a whole note become a whole note
+    :return: a float64 array
+    """
+    durations = numpy.asarray(durations, dtype=numpy.float64)
+    result, _ = find_approximate_in_sorted(durations, standard_duration_list)
+    result = numpy.where(durations > standard_duration_list[-1], standard_duration_list[-1], result)
+    return numpy.where(durations >= standard_duration_list[0], result, fallback_duration)
+
+
 def build_chord_names(bar_notes: List[List[str]]):
     """
     Given a list of bars of which contains list of note names,
@@ -359,3 +528,65 @@ def build_chord_names(bar_notes: List[List[str]]):
                     bar_chords.append(available_chords[0])
                     used.add(available_chords[0])
     return bar_chords
+
+
+# chord inference over bit masks: bit k of a mask is the c major position k + 1, positions above 7 never match
+CHORD_COUNT = len(major_progression)
+chord_member_masks = numpy.array([sum(1 << (pos - 1) for pos in members if pos <= CHORD_COUNT)
+                                  for order, members in major_progression.items()], dtype=numpy.int64)
+# hits of the notes of a bar mask in each chord, 128 x 7
+chord_hit_table = numpy.array([[bin(mask & chord_mask).count('1') for chord_mask in chord_member_masks]
+                               for mask in range(1 << CHORD_COUNT)], dtype=numpy.uint8)
+# lowest set bit of each mask
+first_bit_table = [(mask & -mask).bit_length() - 1 for mask in range(1 << CHORD_COUNT)]
+
+
+def note_names_to_bar_masks(bar_notes: List[List[str]]):
+    """
+    :return: the c major positions of the note names of each bar as 7 bits masks
+    """
+    bar_ids = numpy.repeat(numpy.arange(len(bar_notes)), [len(one_bar) for one_bar in bar_notes])
+    positions = numpy.array([c_major_chord_pos[note_name] for one_bar in bar_notes for note_name in one_bar],
+                            dtype=numpy.int64)
+    masks = numpy.zeros(len(bar_notes), dtype=numpy.int64)
+    numpy.bitwise_or.at(masks, bar_ids, 1 << (positions - 1))
+    return masks
+
+
+def available_chord_masks(bar_masks: numpy.ndarray):
+    """
+    chords_from_note_names of all bars at once
+    :return: for each bar, a mask of the chord orders with the highest hits
+    """
+    hits = chord_hit_table[bar_masks]
+    highest = hits == hits.max(axis=1, keepdims=True)
+    return highest.astype(numpy.int64) @ (1 << numpy.arange(CHORD_COUNT))
+
+
+def select_chord_orders(available_masks: numpy.ndarray):
+    """
+    the greedy selection of build_chord_names: an unused chord, else one different from the last one,
+    else the first available one
+    """
+    orders = []
+    used = 0
+    for i, available in enumerate(available_masks.tolist()):
+        if i > 0 and available & ~used:
+            chosen = first_bit_table[available & ~used]
+        elif i > 0 and available & ~(1 << orders[-1]):
+            chosen = first_bit_table[available & ~(1 << orders[-1])]
+        else:
+            chosen = first_bit_table[available]
+        used |= 1 << chosen
+        orders.append(chosen)
+    return [order + 1 for order in orders]
+
+
+def infer_chord_names(bar_notes: List[List[str]]):
+    """
+    The same result as build_chord_names, with bit masks instead of sets
+    """
+    if len(bar_notes) == 0:
+        return []
+    orders = select_chord_orders(available_chord_masks(note_names_to_bar_masks(bar_notes)))
+    return [c_major_chord_order_map[order] for order in orders]
@@ -1,6 +1,115 @@
-from copy import copy
+from functools import lru_cache
+from typing import List
 
-from model.note import volume_map, Note, drum_map
+import numpy
+
+from model.note import volume_map, Note, drum_map, scale_volumes
+from model.tick import TICK_DTYPE, TICKS_OF_ONE_BAR, beats_to_ticks
+
+# one hit of a drum pattern, velocity is a percentage of the volume of the drum track
+DRUM_HIT_DTYPE = numpy.dtype([('tick', TICK_DTYPE), ('duration_tick', TICK_DTYPE), ('pitch', numpy.uint8),
+                              ('velocity', numpy.uint8)])
+DRUM_HIT_BEATS = 1
+
+
+def drum_cell(hits: List[tuple]):
+    """
+    :param hits: (beat, drum name, velocity) or (beat, drum name, velocity, duration in beats) of each hit,
+                 in the order they are written
+    :return: the hits as a DRUM_HIT_DTYPE array
+    """
+    cell = numpy.array([(beats_to_ticks(hit[0]), beats_to_ticks(hit[3] if len(hit) > 3 else DRUM_HIT_BEATS),
+                         drum_map[hit[1]], hit[2]) for hit in hits], dtype=DRUM_HIT_DTYPE)
+    cell.flags.writeable = False
+    return cell
+
+
+DRUM_STYLE_BASIC = 1
+DRUM_STYLE_ROCK = 2
+DRUM_STYLE_BALLAD = 3
+
+# the one bar cell and the two bars cell of each style
+drum_style_map = {
+    DRUM_STYLE_BASIC: dict(
+        single=drum_cell([(0, 'BassDrum', 100), (0, 'HiHatClosed', 100), (1, 'HiHatClosed', 100),
+                          (2, 'HiHatClosed', 100), (2, 'SnareDrum', 100), (3, 'HiHatClosed', 100)]),
+        double=drum_cell([(0, 'BassDrum', 100), (0, 'HiHatClosed', 100), (1, 'HiHatClosed', 100),
+                          (2, 'HiHatClosed', 100), (2, 'SnareDrum', 100), (3, 'HiHatClosed', 100),
+                          (4, 'BassDrum', 100), (4, 'HiHatClosed', 100), (5, 'BassDrum', 100),
+                          (5, 'HiHatClosed', 100), (6, 'HiHatClosed', 100), (6, 'SnareDrum', 100),
+                          (7, 'HiHatClosed', 100)]),
+    ),
+    DRUM_STYLE_ROCK: dict(
+        single=drum_cell([(0, 'BassDrum', 110), (0, 'HiHatClosed', 100, 0.5), (0.5, 'HiHatClosed', 70, 0.5),
+                          (1, 'SnareDrum', 110), (1, 'HiHatClosed', 100, 0.5), (1.5, 'HiHatClosed', 70, 0.5),
+                          (2, 'BassDrum', 100), (2, 'HiHatClosed', 100, 0.5), (2.5, 'HiHatClosed', 70, 0.5),
+                          (3, 'SnareDrum', 110), (3, 'HiHatClosed', 100, 0.5), (3.5, 'HiHatClosed', 70, 0.5)]),
+        double=drum_cell([(0, 'BassDrum', 110), (0, 'CrashCymbal', 90), (0.5, 'HiHatClosed', 70, 0.5),
+                          (1, 'SnareDrum', 110), (1, 'HiHatClosed', 100, 0.5), (1.5, 'HiHatClosed', 70, 0.5),
+                          (2, 'BassDrum', 100), (2, 'HiHatClosed', 100, 0.5), (2.5, 'BassDrum', 80, 0.5),
+                          (2.5, 'HiHatClosed', 70, 0.5), (3, 'SnareDrum', 110), (3, 'HiHatClosed', 100, 0.5),
+                          (3.5, 'HiHatClosed', 70, 0.5),
+                          (4, 'BassDrum', 110), (4, 'HiHatClosed', 100, 0.5), (4.5, 'HiHatClosed', 70, 0.5),
+                          (5, 'SnareDrum', 110), (5, 'HiHatClosed', 100, 0.5), (5.5, 'HiHatClosed', 70, 0.5),
+                          (6, 'BassDrum', 100), (6, 'HiHatClosed', 100, 0.5), (6.5, 'BassDrum', 80, 0.5),
+                          (6.5, 'HiHatClosed', 70, 0.5), (7, 'SnareDrum', 110), (7, 'HiHatOpen', 90)]),
+    ),
+    DRUM_STYLE_BALLAD: dict(
+        single=drum_cell([(0, 'BassDrum', 100), (0, 'RideCymbal', 80), (1, 'RideCymbal', 60),
+                          (2, 'SnareCrossStick', 90), (2, 'RideCymbal', 80), (3, 'RideCymbal', 60)]),
+        double=drum_cell([(0, 'BassDrum', 100), (0, 'RideCymbal', 80), (1, 'RideCymbal', 60),
+                          (2, 'SnareCrossStick', 90), (2, 'RideCymbal', 80), (3, 'RideCymbal', 60),
+                          (4, 'BassDrum', 100), (4, 'RideCymbal', 80), (5, 'RideCymbal', 60),
+                          (5.5, 'BassDrum', 80, 0.5), (6, 'SnareCrossStick', 90), (6, 'RideCymbal', 80),
+                          (7, 'RideCymbal', 60)]),
+    ),
+}
+
+DRUM_FILL_SNARE = 1
+DRUM_FILL_TOMS = 2
+
+# one bar cells played instead of the last bar of a pattern
+drum_fill_map = {
+    DRUM_FILL_SNARE: drum_cell([(0, 'BassDrum', 100), (0, 'HiHatClosed', 100), (1, 'HiHatClosed', 100),
+                                (2, 'SnareDrum', 80, 0.25), (2.25, 'SnareDrum', 85, 0.25),
+                                (2.5, 'SnareDrum', 90, 0.25), (2.75, 'SnareDrum', 95, 0.25),
+                                (3, 'SnareDrum', 100, 0.25), (3.25, 'SnareDrum', 105, 0.25),
+                                (3.5, 'SnareDrum', 110, 0.25), (3.75, 'SnareDrum', 115, 0.25)]),
+    DRUM_FILL_TOMS: drum_cell([(0, 'BassDrum', 100), (0, 'HiHatClosed', 100), (1, 'SnareDrum', 100),
+                               (2, 'HighTom', 100, 0.5), (2.5, 'HighMidTom', 100, 0.5),
+                               (3, 'LowMidTom', 105, 0.5), (3.5, 'FloorTom1', 110, 0.5)]),
+}
+
+
+def tile_cell(cell: numpy.ndarray, count: int, cell_ticks: int, start_tick: int = 0):
+    """
+    the hits of cell repeated count times, one every cell_ticks from start_tick
+    """
+    hits = numpy.tile(cell, count)
+    hits['tick'] += numpy.repeat(start_tick + cell_ticks * numpy.arange(count, dtype=TICK_DTYPE), len(cell))
+    return hits
+
+
+@lru_cache(maxsize=None)
+def drum_pattern(bar_count: int, style: int = DRUM_STYLE_BASIC, fill: int = None):
+    """
+    hits of bar_count bars from tick 0: the two bars cell of the style repeated,
+    then its one bar cell when bar_count is odd. The fill replaces the hits of the last bar.
+    :return: a read only DRUM_HIT_DTYPE array, ordered by bar
+    """
+    if style not in drum_style_map:
+        raise Exception('unknown drum style %s' % style)
+    cells = drum_style_map[style]
+    pair_count = bar_count // 2
+    hits = numpy.concatenate((tile_cell(cells['double'], pair_count, 2 * TICKS_OF_ONE_BAR),
+                              tile_cell(cells['single'], bar_count % 2, TICKS_OF_ONE_BAR,
+                                        2 * pair_count * TICKS_OF_ONE_BAR)))
+    if fill is not None and bar_count > 0:
+        last_bar_tick = (bar_count - 1) * TICKS_OF_ONE_BAR
+        hits = numpy.concatenate((hits[hits['tick'] < last_bar_tick],
+                                  tile_cell(drum_fill_map[fill], 1, TICKS_OF_ONE_BAR, last_bar_tick)))
+    hits.flags.writeable = False
+    return hits
 
 
 class DrumBar:
@@ -9,53 +118,19 @@ class DrumBar:
         self.std_volume = std_volume
         self.bar_count = bar_count
 
-    def __build_single_bar_style1(self, start_time: int):
-        time = copy(start_time)
-        note1_bass_drum = Note(pitch=drum_map['BassDrum'], volume=self.std_volume, duration=1, time=time)
-        note1_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note2_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note3_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        note3_snare_drum = Note(pitch=drum_map['SnareDrum'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note4_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        return [note1_bass_drum, note1_hat_closed, note2_hat_closed, note3_hat_closed, note3_snare_drum,
-                note4_hat_closed]
-
-    def __build_double_bar_style1(self, start_time: int):
-        time = copy(start_time)
-        bar1 = self.__build_single_bar_style1(start_time=time)
-        time += 4
-        note1_bass_drum = Note(pitch=drum_map['BassDrum'], volume=self.std_volume, duration=1, time=time)
-        note1_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note2_bass_drum = Note(pitch=drum_map['BassDrum'], volume=self.std_volume, duration=1, time=time)
-        note2_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note3_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        note3_snare_drum = Note(pitch=drum_map['SnareDrum'], volume=self.std_volume, duration=1, time=time)
-        time += 1
-        note4_hat_closed = Note(pitch=drum_map['HiHatClosed'], volume=self.std_volume, duration=1, time=time)
-        bar2 = [note1_bass_drum, note1_hat_closed, note2_bass_drum, note2_hat_closed, note3_hat_closed,
-                note3_snare_drum, note4_hat_closed]
-        return [bar1, bar2]
+    def build(self, style: int = DRUM_STYLE_BASIC, fill: int = None):
+        """
+        :return: the notes of each bar
+        """
+        hits = drum_pattern(self.bar_count, style, fill)
+        ticks = (beats_to_ticks(self.start_time) + hits['tick']).tolist()
+        bars = (hits['tick'] // TICKS_OF_ONE_BAR).tolist()
+        bar_notes = [[] for _ in range(self.bar_count)]
+        for bar, pitch, tick, duration_tick, volume in zip(bars, hits['pitch'].tolist(), ticks,
+                                                            hits['duration_tick'].tolist(),
+                                                            scale_volumes(self.std_volume, hits['velocity']).tolist()):
+            bar_notes[bar].append(Note.from_ticks(pitch=pitch, tick=tick, duration_tick=duration_tick, volume=volume))
+        return bar_notes
 
     def build_style1(self):
-        bar_notes = []
-        start_time = copy(self.start_time)
-        if self.bar_count == 1:
-            bar_notes.append(self.__build_single_bar_style1(start_time))
-        elif self.bar_count % 2 == 0:
-            # has something in the end
-            for i in range(0, self.bar_count, 2):
-                bar_notes.extend(self.__build_double_bar_style1(start_time))
-                start_time += 2 * 4
-        else:
-            # remove the last one and add it in the end
-            for i in range(0, self.bar_count - 1, 2):
-                bar_notes.extend(self.__build_double_bar_style1(start_time))
-                start_time += 2 * 4
-            bar_notes.append(self.__build_single_bar_style1(start_time))
-
-        return bar_notes
+        return self.build(DRUM_STYLE_BASIC)
@@ -0,0 +1,192 @@
+from functools import lru_cache
+from typing import List, Callable
+
+import numpy
+
+from model.chord import note_template, CHORD_STYLE, GUITAR_CHORD_STYLE, APPREGIO_STYLE, template_to_note_array
+from model.drum import DRUM_STYLE_BASIC, drum_pattern
+from model.note import NoteArray, note_name_octave_to_pitch
+from model.tick import BEATS_OF_ONE_BAR, TICKS_OF_ONE_BAR, TICK_DTYPE, beats_to_ticks, beats_to_tick_array
+
+
+def build_timeline(bars_of_chord: List[List[str]], phrase_start_ticks: List[int]):
+    """
+    flatten the chord names of every phrase into bar arrays of the whole song
+    :return: a dict of chord_name, bar_tick and bar_phrase by bar, phrase_tick and phrase_bar_count by phrase
+    """
+    phrase_bar_count = numpy.array([len(one_phrase) for one_phrase in bars_of_chord], dtype=numpy.int64)
+    bar_phrase = numpy.repeat(numpy.arange(len(bars_of_chord)), phrase_bar_count)
+    phrase_tick = numpy.array(phrase_start_ticks, dtype=TICK_DTYPE)
+    # position of each bar in its phrase
+    bar_in_phrase = numpy.arange(len(bar_phrase)) - numpy.repeat(numpy.cumsum(phrase_bar_count) - phrase_bar_count,
+                                                                 phrase_bar_count)
+    chord_name = numpy.array([chord_name for one_phrase in bars_of_chord for chord_name in one_phrase],
+                             dtype=numpy.str_)
+    return dict(chord_name=chord_name,
+                bar_tick=(phrase_tick[bar_phrase] + TICKS_OF_ONE_BAR * bar_in_phrase).astype(TICK_DTYPE),
+                bar_phrase=bar_phrase, phrase_tick=phrase_tick, phrase_bar_count=phrase_bar_count)
+
+
+def concatenate_templates(templates: List[dict], offsets: List[float]):
+    """
+    one template playing each given template at its offset in beats
+    """
+    return dict(pitch=numpy.concatenate([template['pitch'] for template in templates]),
+                tick=numpy.concatenate([template['tick'] + beats_to_ticks(offset)
+                                        for template, offset in zip(templates, offsets)]).astype(TICK_DTYPE),
+                duration_tick=numpy.concatenate([template['duration_tick'] for template in templates]))
+
+
+def shifted_octave(chord_name: str, octave: int, shifted_chord_names: str = 'GAB'):
+    # chord may need octave shifting when it comes to higher chord
+    if chord_name in shifted_chord_names:
+        return octave - 1
+    return octave
+
+
+@lru_cache(maxsize=None)
+def chord_bar_template(chord_name: str, octave: int):
+    return note_template(chord_name, octave, CHORD_STYLE, BEATS_OF_ONE_BAR)
+
+
+@lru_cache(maxsize=None)
+def double_chord_bar_template(chord_name: str, octave: int):
+    template = note_template(chord_name, octave, CHORD_STYLE, 2)
+    return concatenate_templates([template, template], [0, 2])
+
+
+GUITAR_CHORD_DURATIONS = [1, 0.5, 0.5, 1, 0.5, 0.25, 0.25]
+
+
+@lru_cache(maxsize=None)
+def guitar_chord_bar_template(chord_name: str, octave: int):
+    offsets = numpy.cumsum([0] + GUITAR_CHORD_DURATIONS[:-1]).tolist()
+    return concatenate_templates([note_template(chord_name, octave, GUITAR_CHORD_STYLE, duration)
+                                  for duration in GUITAR_CHORD_DURATIONS], offsets)
+
+
+@lru_cache(maxsize=None)
+def appregio_bar_template(chord_name: str, octave: int, note_duration: float):
+    return note_template(chord_name, shifted_octave(chord_name, octave), APPREGIO_STYLE, note_duration,
+                         BEATS_OF_ONE_BAR)
+
+
+@lru_cache(maxsize=None)
+def root_note_bar_template(chord_name: str, octave: int):
+    return dict(pitch=numpy.array([note_name_octave_to_pitch(chord_name, octave)], dtype=numpy.int64),
+                tick=numpy.zeros(1, dtype=TICK_DTYPE), duration_tick=numpy.full(1, TICKS_OF_ONE_BAR, dtype=TICK_DTYPE))
+
+
+@lru_cache(maxsize=None)
+def double_root_note_bar_template(chord_name: str, octave: int):
+    pitch = note_name_octave_to_pitch(chord_name, shifted_octave(chord_name, octave))
+    return dict(pitch=numpy.array([pitch, pitch], dtype=numpy.int64), tick=beats_to_tick_array([0, 2]),
+                duration_tick=beats_to_tick_array([2, 2]))
+
+
+@lru_cache(maxsize=None)
+def drum_phrase_template(bar_count: int, style: int = DRUM_STYLE_BASIC, fill: int = None):
+    hits = drum_pattern(bar_count, style, fill)
+    return dict(pitch=hits['pitch'].astype(numpy.int64), tick=hits['tick'], duration_tick=hits['duration_tick'],
+                velocity=hits['velocity'])
+
+
+class Layer:
+    """
+    A pattern generator of one accompaniment instrument.
+    Its template gives the notes of one unit from tick 0, either a bar keyed by its chord name
+    or a whole phrase keyed by its bar count.
+    build emits the notes of every enabled unit of the song in one NoteArray.
+    """
+
+    BAR = 'bar'
+    PHRASE = 'phrase'
+
+    def __init__(self, channel_name: str, volume: int, template: Callable, unit: str = BAR):
+        self.channel_name = channel_name
+        self.volume = volume
+        self.template = template
+        self.unit = unit
+
+    def build(self, timeline: dict, enabled_phrases: numpy.ndarray):
+        """
+        :param timeline: see build_timeline
+        :param enabled_phrases: whether the layer plays, by phrase
+        :return: the NoteArray of the layer ordered by unit, and the phrase of each note
+        """
+        if self.unit == Layer.BAR:
+            keys, ticks, phrases = timeline['chord_name'], timeline['bar_tick'], timeline['bar_phrase']
+        else:
+            keys, ticks = timeline['phrase_bar_count'], timeline['phrase_tick']
+            phrases = numpy.arange(len(ticks))
+        units = numpy.flatnonzero(enabled_phrases[phrases])
+        if len(units) == 0:
+            return NoteArray.create(), numpy.empty(0, dtype=numpy.int64)
+
+        unique_keys, key_index = numpy.unique(keys[units], return_inverse=True)
+        chunks = []
+        chunk_units = []
+        for k, key in enumerate(unique_keys.tolist()):
+            selected = units[key_index == k]
+            template = self.template(key)
+            chunks.append(template_to_note_array(template, ticks[selected], self.volume))
+            chunk_units.append(numpy.repeat(selected, len(template['pitch'])))
+        notes = numpy.concatenate(chunks)
+        note_units = numpy.concatenate(chunk_units)
+        # back to the unit order, the notes of a unit keep their template order
+        order = numpy.lexsort((numpy.arange(len(notes)), note_units))
+        return notes[order], phrases[note_units[order]]
+
+
+class PhraseMemo:
+    """
+    The accompaniment notes of a phrase for every track from tick 0, keyed by the phrase content:
+    the chord names of its bars and the instruments playing it.
+    Repeated phrases are replayed at their own start tick instead of being built again.
+    A memo is only valid for one set of layers, see arrangement_layer_map.
+    """
+
+    def __init__(self):
+        # key to a dict of NoteArray by channel name
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'PhraseMemo entries = %d, hits = %d, misses = %d' % (len(self.entries), self.hits, self.misses)
+
+
+def replay_phrase(entry: numpy.ndarray, phrase_tick: int):
+    """
+    notes of one track for a single phrase playing entry from phrase_tick, the same as replay_phrases
+    """
+    notes = entry.copy()
+    notes['tick'] += phrase_tick
+    return notes
+
+
+def replay_phrases(entries: List[numpy.ndarray], phrase_entries: numpy.ndarray, phrase_ticks: numpy.ndarray):
+    """
+    notes of one track for the whole song, each phrase playing its entry from its start tick
+    :param entries: relative NoteArray of each distinct phrase
+    :param phrase_entries: entry index of each phrase
+    :return: a NoteArray ordered by phrase
+    """
+    by_entry = numpy.argsort(phrase_entries, kind='stable')
+    bounds = numpy.searchsorted(phrase_entries[by_entry], numpy.arange(len(entries) + 1)).tolist()
+    chunks = []
+    chunk_phrases = []
+    chunk_positions = []
+    for k, entry in enumerate(entries):
+        phrases = by_entry[bounds[k]:bounds[k + 1]]
+        if len(entry) == 0 or len(phrases) == 0:
+            continue
+        notes = numpy.tile(entry, len(phrases))
+        notes['tick'] += numpy.repeat(phrase_ticks[phrases], len(entry))
+        chunks.append(notes)
+        chunk_phrases.append(numpy.repeat(phrases, len(entry)))
+        chunk_positions.append(numpy.tile(numpy.arange(len(entry)), len(phrases)))
+    if len(chunks) == 0:
+        return NoteArray.create()
+    notes = numpy.concatenate(chunks)
+    return notes[numpy.lexsort((numpy.concatenate(chunk_positions), numpy.concatenate(chunk_phrases)))]
@@ -1,8 +1,13 @@
-from copy import copy
 from typing import List
 
-from model.chord import shift_to_standard_duration, shift_to_c_major_pitch, shift_to_standard_volume
-from model.note import Note
+import numpy
+
+from model.chord import shift_to_standard_duration_array, shift_to_c_major_pitch_array, \
+    shift_to_standard_volume_array
+from model.note import Note, NoteArray
+from model.tick import BEATS_OF_ONE_BAR, TICKS_OF_ONE_BAR, beats_to_ticks, beats_to_tick_array, tick_array_to_beats
+
+SIXTEENTHS_OF_ONE_BEAT = 4
 
 
 class Melody:
@@ -10,54 +15,72 @@ class Melody:
     Given a list of notes with pitch, duration and volume.
     This class help us to build a melody regardless of notes' start time.
     It will divide all notes according to duration into bars of 4/4.
+    :param carry_overflow: a note which does not fit in a bar starts the next bar, instead of being dropped
     """
 
-    def __init__(self, note_list: List[Note], start_time: int = 0):
+    def __init__(self, note_list: List[Note], start_time: int = 0, carry_overflow: bool = False):
         self.input_note_list = note_list
         self.bar_note_result_list = []
         self.start_time = start_time
+        self.carry_overflow = carry_overflow
+        # the same notes as columns, with the bar of each note
+        self.note_array = NoteArray.create()
+        self.note_bar = numpy.empty(0, dtype=numpy.int64)
 
     def build(self):
-        # standardize the durations
-        durations = [note.duration / 100 for note in self.input_note_list]
-        durations = shift_to_standard_duration(durations)
+        # standardize the durations, pitches and volumes
+        durations = shift_to_standard_duration_array([note.duration / 100 for note in self.input_note_list])
+        pitches = shift_to_c_major_pitch_array(numpy.array([note.pitch for note in self.input_note_list],
+                                                           dtype=numpy.int64))
+        volumes = shift_to_standard_volume_array(numpy.array([note.volume for note in self.input_note_list],
+                                                             dtype=numpy.int64))
 
-        pitches = [note.pitch for note in self.input_note_list]
-        pitches = shift_to_c_major_pitch(pitches)
+        # then with durations, we can split notes into bars.
+        # the condition is simple, one bar should not have sum duration > 4
+        bar_starts, bar_ends = self.__split_bars(durations)
+        lengths = bar_ends - bar_starts
+        note_bar = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        first_of_bar = numpy.repeat(bar_starts, lengths)
+        kept = numpy.arange(len(note_bar)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + first_of_bar
 
-        volumes = [note.volume for note in self.input_note_list]
-        volumes = shift_to_standard_volume(volumes)
+        # each note starts after the notes before it in its bar
+        duration_ticks = beats_to_tick_array(durations)
+        elapsed = numpy.concatenate(([0], numpy.cumsum(duration_ticks, dtype=numpy.int64)))
+        ticks = beats_to_ticks(self.start_time) + TICKS_OF_ONE_BAR * note_bar + (elapsed[kept] - elapsed[first_of_bar])
 
-        std_notes = []
-        for i, input_note in enumerate(self.input_note_list):
-            # start time still unknown
-            std_notes.append(Note(pitch=pitches[i], duration=durations[i], volume=volumes[i], time=0))
+        note_array = NoteArray.create(len(kept))
+        note_array['pitch'] = pitches[kept]
+        note_array['tick'] = ticks
+        note_array['duration_tick'] = duration_ticks[kept]
+        note_array['volume'] = volumes[kept]
+        self.note_array = note_array
+        self.note_bar = note_bar
 
-        # then with durations, we can split notes into bars.
-        # the condition is simple, one bar should not have sum duration > 4
-        bar_note_result_list = []
-        bar_note_result = []
-        beats_of_one_bar = 4
-        sum_duration = 0
-        for i, duration in enumerate(durations):
-            if sum_duration + duration <= beats_of_one_bar:
-                bar_note_result.append(std_notes[i])
-                sum_duration += duration
-            else:
-                # create a new bar, persist that last bar
-                bar_note_result_list.append(bar_note_result)
-                bar_note_result = []
-                sum_duration = 0
-
-        # we have divided notes into melody
-        # compute each note's start time
-        start_time = copy(self.start_time)
-        for one_bar in bar_note_result_list:
-            bar_start_time = start_time
-            for note in one_bar:
-                note.time = bar_start_time
-                bar_start_time += note.duration
-            start_time += beats_of_one_bar
-
-        self.bar_note_result_list = bar_note_result_list
+        notes = [Note(pitch=pitch, time=time, duration=duration, volume=volume)
+                 for pitch, time, duration, volume in zip(pitches[kept].tolist(), tick_array_to_beats(ticks).tolist(),
+                                                          durations[kept].tolist(), volumes[kept].tolist())]
+        bounds = numpy.cumsum(lengths).tolist()
+        self.bar_note_result_list = [notes[start:end] for start, end in zip([0] + bounds[:-1], bounds)]
         return self
+
+    def __split_bars(self, durations: numpy.ndarray):
+        """
+        A bar takes the notes until one does not fit, which is dropped or starts the next bar.
+        The last bar is never complete and is dropped.
+        :return: first and last + 1 note index of each bar
+        """
+        count = len(durations)
+        # standard durations are whole sixteenths
+        sixteenths = numpy.rint(durations * SIXTEENTHS_OF_ONE_BEAT).astype(numpy.int64)
+        elapsed = numpy.concatenate(([0], numpy.cumsum(sixteenths)))
+        # the end of a bar which would start at each note
+        ends = (numpy.searchsorted(elapsed, elapsed[:-1] + BEATS_OF_ONE_BAR * SIXTEENTHS_OF_ONE_BEAT,
+                                   side='right') - 1).tolist()
+        bar_starts = []
+        bar_ends = []
+        start = 0
+        while start < count and ends[start] < count:
+            bar_starts.append(start)
+            bar_ends.append(ends[start])
+            start = ends[start] if self.carry_overflow else ends[start] + 1
+        return numpy.array(bar_starts, dtype=numpy.int64), numpy.array(bar_ends, dtype=numpy.int64)
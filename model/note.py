@@ -1,27 +1,105 @@
+from typing import List
+
+import numpy
+
+from model.tick import TICK_DTYPE, beats_to_ticks, ticks_to_beats, tick_array_to_beats
+
+
 class Note:
     """
     A note is a note with all arguments required for MIDIUtil's addNote function
-    :param note_name is C5 like str
+    :param note_name is C5 like str, derived from the pitch when not given
+    time and duration are in beats, tick and duration_tick give them on the integer timeline of model.tick
     """
 
+    __slots__ = ('pitch', 'time', 'duration', 'volume', '__note_name')
+
     def __init__(self, pitch: int, time: int, duration: int, volume: int, note_name: str = ''):
         self.pitch = int(round(pitch))
         self.time = float(time)
         self.duration = float(duration)
         self.volume = int(volume)
-        if note_name != '':
-            self.note_name = note_name
-        elif self.pitch in reverse_note_map:
-            # pitch to c major note name
-            self.note_name = reverse_note_map[self.pitch]
-        else:
-            self.note_name = ''
+        self.__note_name = note_name if note_name != '' else None
+
+    @property
+    def note_name(self):
+        if self.__note_name is None:
+            return pitch_to_note_name(self.pitch)
+        return self.__note_name
+
+    @note_name.setter
+    def note_name(self, note_name: str):
+        self.__note_name = note_name
+
+    @property
+    def tick(self):
+        return beats_to_ticks(self.time)
+
+    @property
+    def duration_tick(self):
+        return beats_to_ticks(self.duration)
+
+    @staticmethod
+    def from_ticks(pitch: int, tick: int, duration_tick: int, volume: int, note_name: str = ''):
+        return Note(pitch=pitch, time=ticks_to_beats(tick), duration=ticks_to_beats(duration_tick), volume=volume,
+                    note_name=note_name)
 
     def __repr__(self):
         return 'Note note_name = %s, pitch = %d, time = %f, duration = %f, volume = %d' % (
             self.note_name, self.pitch, self.time, self.duration, self.volume)
 
 
+class NoteArray:
+    """
+    Column storage of many notes, as a numpy structured array of DTYPE.
+    Times and durations are integer ticks, see model.tick.
+    """
+
+    DTYPE = numpy.dtype([('pitch', numpy.uint8), ('tick', TICK_DTYPE), ('duration_tick', TICK_DTYPE),
+                         ('volume', numpy.uint8), ('track', numpy.uint8), ('channel', numpy.uint8)])
+
+    @staticmethod
+    def create(count: int = 0):
+        return numpy.zeros(count, dtype=NoteArray.DTYPE)
+
+    @staticmethod
+    def from_notes(notes: List[Note], track: int = 0, channel: int = 0):
+        result = NoteArray.create(len(notes))
+        result['pitch'] = [note.pitch for note in notes]
+        result['tick'] = [note.tick for note in notes]
+        result['duration_tick'] = [note.duration_tick for note in notes]
+        result['volume'] = [note.volume for note in notes]
+        result['track'] = track
+        result['channel'] = channel
+        return result
+
+    @staticmethod
+    def to_notes(note_array: numpy.ndarray):
+        return [Note(pitch=pitch, time=time, duration=duration, volume=volume)
+                for pitch, time, duration, volume in zip(note_array['pitch'].tolist(),
+                                                         tick_array_to_beats(note_array['tick']).tolist(),
+                                                         tick_array_to_beats(note_array['duration_tick']).tolist(),
+                                                         note_array['volume'].tolist())]
+
+
+# c major note letters by pitch class, black keys have no name
+pitch_class_letters = ('C', '', 'D', '', 'E', 'F', '', 'G', '', 'A', '', 'B')
+MIN_NOTE_PITCH = 12
+MAX_NOTE_PITCH = 120
+
+
+def pitch_to_note_name(pitch: int):
+    """
+    the same as reverse_note_map lookup: C5 like name of a c major pitch, '' otherwise
+    """
+    if pitch < MIN_NOTE_PITCH or pitch > MAX_NOTE_PITCH:
+        return ''
+    letter = pitch_class_letters[pitch % 12]
+    if letter == '':
+        return ''
+    return letter + str(pitch // 12 - 1)
+
+
 def note_name_to_pitch(name: str):
     if name in note_map:
         return note_map[name]
@@ -56,6 +134,14 @@ volume_map = dict(
 reverse_volume_map = {v: k for k, v in volume_map.items()}
 standard_volume_list = [v for k, v in volume_map.items()]
 
+
+def scale_volumes(volume: int, percents: numpy.ndarray):
+    """
+    midi volumes of notes played at percents of volume, accents above 100
+    """
+    return numpy.clip(volume * numpy.asarray(percents, dtype=numpy.int64) // 100, 1, 127)
+
+
 note_map = dict(
     C0=12,
     D0=14,
@@ -1,7 +1,7 @@
 from copy import copy
 from typing import List
 
-from model.chord import chords_from_note_names, get_in_chord_notes, Chord, Appregio, build_chord_names
+from model.chord import chords_from_note_names, get_in_chord_notes, Chord, Appregio, infer_chord_names
 from model.note import note_name_octave_to_pitch, Note, volume_map, duration_map
 
 
@@ -26,7 +26,7 @@ class Phrase:
         using given notes to generate several chords of one phrase.
         """
         bar_notes = self.build_note_names()
-        return build_chord_names(bar_notes)
+        return infer_chord_names(bar_notes)
 
     def build_note_names(self):
         """
@@ -1,10 +1,43 @@
 from typing import List
 
-from copy import copy, deepcopy
+from copy import copy
 
-from model.chord import build_chord_names, Chord, Appregio
-from model.drum import DrumBar
-from model.note import Note, volume_map, note_name_to_pitch, note_name_octave_to_pitch, duration_map
+import numpy
+
+from model.chord import infer_chord_names, Chord, Appregio
+from model.drum import DrumBar, DRUM_STYLE_BASIC
+from model.note import Note, volume_map, note_name_octave_to_pitch, duration_map, \
+    MIN_NOTE_PITCH, MAX_NOTE_PITCH
+from model.tick import TICKS_PER_BEAT, TICKS_OF_ONE_BAR, beats_to_ticks, ticks_to_beats
+
+# octaves of the c major notes of note_map
+OCTAVE_COUNT = 10
+
+
+def converge_octaves(pitches: numpy.ndarray, phrase_ids: numpy.ndarray, phrase_count: int, reference_octave: int):
+    """
+    The octave convergence of Phrase2.standardize for the notes of many phrases at once.
+    In each phrase, the lower half of the distinct octaves moves to reference_octave and the upper half to
+    reference_octave + 1, the middle one goes to the upper half as round() does.
+    :param pitches: c major pitches, the octave of a note is the one of its pitch
+    :param phrase_ids: phrase of each note
+    :return: the shifted pitches, which may be out of note_map for extreme reference octaves
+    """
+    pitches = numpy.asarray(pitches, dtype=numpy.int64)
+    phrase_ids = numpy.asarray(phrase_ids, dtype=numpy.int64)
+    white = numpy.isin(pitches % 12, [0, 2, 4, 5, 7, 9, 11]) & (pitches >= MIN_NOTE_PITCH) & \
+        (pitches <= MAX_NOTE_PITCH)
+    if not white.all():
+        raise Exception('unable to converge pitch %d, not a c major note' % pitches[~white][0])
+    octaves = pitches // 12 - 1
+    present = numpy.zeros((phrase_count, OCTAVE_COUNT), dtype=bool)
+    present[phrase_ids, octaves] = True
+    # numpy rounds half to even, like round()
+    split = numpy.round(present.sum(axis=1) / 2)
+    rank = numpy.cumsum(present, axis=1) - 1
+    target_octaves = numpy.where(rank[phrase_ids, octaves] < split[phrase_ids], reference_octave,
+                                 reference_octave + 1)
+    return pitches + 12 * (target_octaves - octaves)
 
 
 class Phrase2:
@@ -15,6 +48,7 @@ class Phrase2:
     def __init__(self, bars_of_notes: List[List[Note]], start_time: int = 0):
         self.bars_of_notes = bars_of_notes
         self.start_time = copy(start_time)
+        self.start_tick = beats_to_ticks(start_time)
         self.bars_of_chord = self.__build_chord_names()
 
     def __build_chord_names(self):
@@ -28,69 +62,68 @@ class Phrase2:
                 bar_of_note_names.append(note.note_name[0])
             bars_of_note_names.append(bar_of_note_names)
 
-        return build_chord_names(bars_of_note_names)
+        return infer_chord_names(bars_of_note_names)
+
+    def bar_start_ticks(self):
+        """
+        start tick of each bar of the phrase
+        """
+        return [self.start_tick + i * TICKS_OF_ONE_BAR for i in range(len(self.bars_of_chord))]
 
     def build_chords(self, std_octave: int, volume: int = volume_map['p']):
         """
         in stead of chord names, build real notes of chords
         """
         chords = []
-        start_time = copy(self.start_time)
-        for chord_name in self.bars_of_chord:
+        for chord_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
             # chord may need octave shifting when it comes to higher chord
             if chord_name in ['G', 'A', 'B']:
                 octave -= 1
             # The nature octave is 3 below notes melody
             chord = Chord.create_from_name_and_octave(chord_name=chord_name, octave=std_octave,
-                                                      time=start_time, duration=4,
+                                                      time=ticks_to_beats(start_tick), duration=4,
                                                       volume=volume)
             chords.append(chord)
-            start_time += 4
         return chords
 
     def build_double_chord(self, std_octave: int, volume: int = volume_map['p']):
         chords = []
-        start_time = copy(self.start_time)
-        for chord_name in self.bars_of_chord:
+        for chord_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
             # chord may need octave shifting when it comes to higher chord
             if chord_name in ['G', 'A', 'B']:
                 octave -= 1
             chord1 = Chord.create_from_name_and_octave(chord_name=chord_name, octave=std_octave,
-                                                       time=start_time, duration=2,
+                                                       time=ticks_to_beats(start_tick), duration=2,
                                                        volume=volume)
             chord2 = Chord.create_from_name_and_octave(chord_name=chord_name, octave=std_octave,
-                                                       time=start_time + 2, duration=2,
-                                                       volume=volume)
+                                                       time=ticks_to_beats(start_tick + 2 * TICKS_PER_BEAT),
+                                                       duration=2, volume=volume)
             chords.append(chord1)
             chords.append(chord2)
-            start_time += 4
         return chords
 
     def build_guitar_chord(self, std_octave: int, volume: int = volume_map['ppp']):
         chords = []
-        start_time = copy(self.start_time)
-        for chord_name in self.bars_of_chord:
+        for chord_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
             if chord_name in ['E', 'F', 'G']:
                 octave -= 1
             # count the beat
             durations = [1, 0.5, 0.5, 1, 0.5, 0.25, 0.25]
-            start_time_in_bar = copy(start_time)
+            tick_in_bar = start_tick
             for duration in durations:
                 chord = Chord.create_guitar_chord_from_name_and_octave(chord_name=chord_name, octave=std_octave,
-                                                                       time=start_time_in_bar, duration=duration,
-                                                                       volume=volume)
-                start_time_in_bar += duration
+                                                                       time=ticks_to_beats(tick_in_bar),
+                                                                       duration=duration, volume=volume)
+                tick_in_bar += beats_to_ticks(duration)
                 chords.append(chord)
-            start_time += 4
         return chords
 
     def build_appregios(self, std_octave: int, volume: int = volume_map['f'], style: int = 1):
         appregios = []
-        start_time = copy(self.start_time)
-        for chord_name in self.bars_of_chord:
+        for chord_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
             # chord may need octave shifting when it comes to A or B chord
             if chord_name in ['G', 'A', 'B']:
@@ -100,40 +133,41 @@ class Phrase2:
             if style == 2:
                 note_duration = duration_map['eighth_note']
             appregio = Appregio.create(chord_name=chord_name, octave=octave,
-                                       time=start_time, volume=volume, note_duration=note_duration)
+                                       time=ticks_to_beats(start_tick), volume=volume, note_duration=note_duration)
             appregios.append(appregio)
-            start_time += 4
         return appregios
 
     def build_root_note(self, std_octave: int, volume: int = volume_map['p']):
         root_notes = []
-        start_time = copy(self.start_time)
-        for note_name in self.bars_of_chord:
+        for note_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
-            note = Note(pitch=note_name_octave_to_pitch(note_name, octave), duration=4, time=start_time, volume=volume)
+            note = Note.from_ticks(pitch=note_name_octave_to_pitch(note_name, octave), tick=start_tick,
+                                   duration_tick=TICKS_OF_ONE_BAR, volume=volume)
             root_notes.append(note)
-            start_time += 4
         return root_notes
 
     def build_double_root_note(self, std_octave: int, volume: int = volume_map['p']):
         root_notes = []
-        start_time = copy(self.start_time)
-        for note_name in self.bars_of_chord:
+        for note_name, start_tick in zip(self.bars_of_chord, self.bar_start_ticks()):
             octave = copy(std_octave)
             # chord may need octave shifting when it comes to higher chord
             if note_name in ['G', 'A', 'B']:
                 octave -= 1
-            note1 = Note(pitch=note_name_octave_to_pitch(note_name, octave), duration=2, time=start_time, volume=volume)
-            note2 = Note(pitch=note_name_octave_to_pitch(note_name, octave), duration=2, time=start_time + 2,
-                         volume=volume)
+            pitch = note_name_octave_to_pitch(note_name, octave)
+            note1 = Note.from_ticks(pitch=pitch, tick=start_tick, duration_tick=2 * TICKS_PER_BEAT, volume=volume)
+            note2 = Note.from_ticks(pitch=pitch, tick=start_tick + 2 * TICKS_PER_BEAT,
+                                    duration_tick=2 * TICKS_PER_BEAT, volume=volume)
             root_notes.append(note1)
             root_notes.append(note2)
-            start_time += 4
         return root_notes
 
-    def build_drum(self, volume: int = volume_map['p'], style: int = 1):
-        start_time = copy(self.start_time)
-        return DrumBar(start_time=start_time, std_volume=volume, bar_count=len(self.bars_of_notes)).build_style1()
+    def build_drum(self, volume: int = volume_map['p'], style: int = DRUM_STYLE_BASIC, fill: int = None):
+        """
+        :param style: a style of drum_style_map
+        :param fill: a fill of drum_fill_map played on the last bar, or None
+        """
+        return DrumBar(start_time=ticks_to_beats(self.start_tick), std_volume=volume,
+                       bar_count=len(self.bars_of_notes)).build(style, fill)
 
     def standardize(self, std_octave: int = 6):
         """
@@ -145,34 +179,20 @@ class Phrase2:
         return self
 
     def __converge_notes(self, reference_octave: int):
-        # Try to identify the boundary
-        octave_seq = []
+        notes = [note for one_bar in self.bars_of_notes for note in one_bar]
+        pitches = converge_octaves([note.pitch for note in notes], numpy.zeros(len(notes)), 1,
+                                   reference_octave).tolist()
+        # new notes with the shifted pitches, the notes of the phrase are left untouched
+        bars_of_notes = []
+        i = 0
         for one_bar in self.bars_of_notes:
+            shifted_bar = []
             for note in one_bar:
-                octave_seq.append(note.note_name[1])
-        octave_seq_set = set(octave_seq)
-        # move all into 2 octave
-        octave_seq_set = sorted(octave_seq_set)
-        # @TODO: test: potential improvement will be compute the middle hits to define the shifting algo
-        # maybe a group of two ?
-        i = round(len(octave_seq_set) / 2)
-        set1 = octave_seq_set[0:i]
-        set2 = octave_seq_set[i:len(octave_seq_set)]
-        set1_to_octave = reference_octave
-        set2_to_octave = reference_octave + 1
-        # make a copy of notes and shift their octaves
-        bars_of_notes = deepcopy(self.bars_of_notes)
-        for one_bar in bars_of_notes:
-            for note in one_bar:
-                note_octave = note.note_name[1]
-                if note_octave in set1:
-                    note_name = note.note_name[0] + str(set1_to_octave)
-                elif note_octave in set2:
-                    note_name = note.note_name[0] + str(set2_to_octave)
-                else:
-                    note_name = note.note_name
-                # redefine the pitch value
-                # print('shifting... from %s to %s' % (note.note_name, note_name))
-                note.pitch = note_name_to_pitch(note_name)
-                note.note_name = note_name
+                if pitches[i] < MIN_NOTE_PITCH or pitches[i] > MAX_NOTE_PITCH:
+                    raise ValueError('pitch %d converged to %d, out of the note range %d - %d' %
+                                     (note.pitch, pitches[i], MIN_NOTE_PITCH, MAX_NOTE_PITCH))
+                shifted_bar.append(Note(pitch=pitches[i], time=note.time, duration=note.duration,
+                                        volume=note.volume))
+                i += 1
+            bars_of_notes.append(shifted_bar)
         return bars_of_notes
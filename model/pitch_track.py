@@ -0,0 +1,89 @@
+from typing import List
+
+import numpy
+
+
+class PitchTrack:
+    """
+    A PitchTrack is the column storage of the pitch frames read from a sound file.
+    time, pitch and confidence are float32 arrays, a frame takes 12 bytes instead of a dict per frame.
+    Indexing with an integer returns a dict of time, pitch and confidence like the former frame dicts,
+    slicing returns another PitchTrack which shares the same memory.
+    """
+
+    DTYPE = numpy.float32
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self, time: numpy.ndarray = None, pitch: numpy.ndarray = None, confidence: numpy.ndarray = None):
+        if time is None:
+            time = numpy.empty(PitchTrack.INITIAL_CAPACITY, dtype=PitchTrack.DTYPE)
+            pitch = numpy.empty(PitchTrack.INITIAL_CAPACITY, dtype=PitchTrack.DTYPE)
+            confidence = numpy.empty(PitchTrack.INITIAL_CAPACITY, dtype=PitchTrack.DTYPE)
+            self.length = 0
+        else:
+            if not len(time) == len(pitch) == len(confidence):
+                raise Exception('time, pitch and confidence columns have different lengths')
+            self.length = len(time)
+        self.__time = numpy.asarray(time, dtype=PitchTrack.DTYPE)
+        self.__pitch = numpy.asarray(pitch, dtype=PitchTrack.DTYPE)
+        self.__confidence = numpy.asarray(confidence, dtype=PitchTrack.DTYPE)
+
+    @property
+    def time(self):
+        return self.__time[:self.length]
+
+    @property
+    def pitch(self):
+        return self.__pitch[:self.length]
+
+    @property
+    def confidence(self):
+        return self.__confidence[:self.length]
+
+    def append(self, time: float, pitch: float, confidence: float):
+        if self.length == len(self.__time):
+            self.__grow()
+        self.__time[self.length] = time
+        self.__pitch[self.length] = pitch
+        self.__confidence[self.length] = confidence
+        self.length += 1
+
+    def __grow(self):
+        # double the capacity, the columns of a slice are copied here instead of being written through
+        capacity = max(2 * len(self.__time), PitchTrack.INITIAL_CAPACITY)
+        self.__time = self.__copy_column(self.__time, capacity)
+        self.__pitch = self.__copy_column(self.__pitch, capacity)
+        self.__confidence = self.__copy_column(self.__confidence, capacity)
+
+    def __copy_column(self, column: numpy.ndarray, capacity: int):
+        result = numpy.empty(capacity, dtype=PitchTrack.DTYPE)
+        result[:self.length] = column[:self.length]
+        return result
+
+    @staticmethod
+    def concatenate(tracks: List['PitchTrack']):
+        if len(tracks) == 0:
+            return PitchTrack()
+        return PitchTrack(numpy.concatenate([track.time for track in tracks]),
+                          numpy.concatenate([track.pitch for track in tracks]),
+                          numpy.concatenate([track.confidence for track in tracks]))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return PitchTrack(self.time[item], self.pitch[item], self.confidence[item])
+        if item < 0:
+            item += self.length
+        if item < 0 or item >= self.length:
+            raise IndexError('pitch track index out of range')
+        return dict(time=float(self.__time[item]), pitch=float(self.__pitch[item]),
+                    confidence=float(self.__confidence[item]))
+
+    def __reduce__(self):
+        # only the used part of the columns is pickled
+        return PitchTrack, (self.time, self.pitch, self.confidence)
+
+    def __repr__(self):
+        return 'PitchTrack length = %d' % self.length
@@ -0,0 +1,27 @@
+import numpy
+from midiutil.MidiFile import TICKSPERQUARTERNOTE
+
+# the integer timeline of the model, a beat is a quarter note of the midi file
+TICKS_PER_BEAT = TICKSPERQUARTERNOTE
+TICK_DTYPE = numpy.int32
+BEATS_OF_ONE_BAR = 4
+TICKS_OF_ONE_BAR = BEATS_OF_ONE_BAR * TICKS_PER_BEAT
+
+
+def beats_to_ticks(beats: float):
+    """
+    the nearest tick, so that ticks_to_beats then beats_to_ticks gives back the same tick
+    """
+    return int(round(beats * TICKS_PER_BEAT))
+
+
+def beats_to_tick_array(beats: numpy.ndarray):
+    return numpy.rint(numpy.asarray(beats, dtype=numpy.float64) * TICKS_PER_BEAT).astype(TICK_DTYPE)
+
+
+def ticks_to_beats(ticks: int):
+    return ticks / TICKS_PER_BEAT
+
+
+def tick_array_to_beats(ticks: numpy.ndarray):
+    return numpy.asarray(ticks, dtype=numpy.float64) / TICKS_PER_BEAT
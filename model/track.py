@@ -1,8 +1,10 @@
+import numpy
 from midiutil import MIDIFile
 
 from model.channel import channel_map, get_channel_program_int, reversed_channel_map, channel_panning_map
 from model.chord import Chord, Appregio
 from model.note import Note
+from model.tick import tick_array_to_beats
 
 
 class Track:
@@ -18,6 +20,8 @@ class Track:
         self.channel = channel
         self.tempo = tempo
         self.track_name = track_name
+        # the model times are written as they are when the midi file takes ticks, see model.tick
+        self.eventtime_is_ticks = getattr(midi_instance, 'eventtime_is_ticks', False)
 
     @staticmethod
     def create_track(midi_instance: MIDIFile, track: int, channel: int, tempo: int, track_name: str = ''):
@@ -52,8 +56,30 @@ class Track:
     def add_note(self, note: Note):
         # print("Track %d add note with pitch = %d, time = %f, duration = %f, volume = %d" %
         #       (self.track, note.pitch, note.time, note.duration, note.volume))
-        self.midi_instance.addNote(track=self.track, channel=self.channel, pitch=note.pitch, time=note.time,
-                                   duration=note.duration, volume=note.volume)
+        if self.eventtime_is_ticks:
+            time, duration = note.tick, note.duration_tick
+        else:
+            time, duration = note.time, note.duration
+        self.midi_instance.addNote(track=self.track, channel=self.channel, pitch=note.pitch, time=time,
+                                   duration=duration, volume=note.volume)
+
+    def add_note_array(self, note_array: numpy.ndarray):
+        """
+        add the notes of a NoteArray on this track and channel, in bulk when the midi file supports it
+        """
+        if hasattr(self.midi_instance, 'addNotes'):
+            self.midi_instance.addNotes(track=self.track, channel=self.channel, pitches=note_array['pitch'],
+                                        ticks=note_array['tick'], duration_ticks=note_array['duration_tick'],
+                                        volumes=note_array['volume'])
+            return
+        if self.eventtime_is_ticks:
+            times, durations = note_array['tick'], note_array['duration_tick']
+        else:
+            times, durations = tick_array_to_beats(note_array['tick']), tick_array_to_beats(note_array['duration_tick'])
+        for pitch, time, duration, volume in zip(note_array['pitch'].tolist(), times.tolist(), durations.tolist(),
+                                                 note_array['volume'].tolist()):
+            self.midi_instance.addNote(track=self.track, channel=self.channel, pitch=pitch, time=time,
+                                       duration=duration, volume=volume)
 
     def add_chord(self, chord: Chord):
         for note in chord.notes:
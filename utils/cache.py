@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import pickle
+
+DEFAULT_CACHE_DIRECTORY = './.analysis_cache'
+# 512 MB
+DEFAULT_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+
+class AnalysisCache:
+    """
+    An on-disk cache of sound analysis results.
+    Each entry is a pickle file named after the hash of the input file content and the hash of the analysis
+    parameters, so renaming a file keeps its entry and changing a parameter misses it.
+    When the directory grows over max_size, the least recently used entries are removed.
+    """
+
+    # bump it whenever the format of the stored results changes
+    VERSION = 3
+    EXTENSION = '.pkl'
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY, max_size: int = DEFAULT_CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_hash(filename: str):
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def key(self, filename: str, params: dict):
+        """
+        :param filename: the analysed sound file, only its content matters
+        :param params: every parameter which changes the analysis result
+        """
+        params = dict(params, version=AnalysisCache.VERSION)
+        params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        return '%s-%s' % (AnalysisCache.file_hash(filename), params_hash)
+
+    def __path(self, key: str):
+        return os.path.join(self.directory, key + AnalysisCache.EXTENSION)
+
+    def __entries(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(AnalysisCache.EXTENSION)]
+
+    def get(self, key: str):
+        path = self.__path(key)
+        if os.path.isfile(path) is False:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # mark as recently used for the eviction
+            os.utime(path, None)
+        except FileNotFoundError:
+            # evicted by another process meanwhile
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            print("Warning====> removing unreadable cache entry %s" % path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return value
+
+    def put(self, key: str, value):
+        path = self.__path(key)
+        # several batch workers may share the cache directory
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for path in self.__entries():
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                # removed by another process meanwhile
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def invalidate(self, filename: str = None):
+        """
+        remove the entries of the given sound file, or every entry if no file is given
+        :return: the number of removed entries
+        """
+        prefix = None
+        if filename is not None:
+            prefix = AnalysisCache.file_hash(filename) + '-'
+        removed = 0
+        for path in self.__entries():
+            if prefix is None or os.path.basename(path).startswith(prefix):
+                os.remove(path)
+                removed += 1
+        return removed
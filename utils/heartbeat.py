@@ -0,0 +1,233 @@
+import os
+import subprocess
+import tempfile
+import wave
+from collections import OrderedDict
+from typing import List
+
+import numpy
+from pydub import AudioSegment
+from pydub.utils import get_encoder_name
+
+# positions in ms of the two beats of a heartbeat inside the source sample
+HEART_BEAT_1_RANGE = (70, 180)
+HEART_BEAT_2_RANGE = (380, 490)
+
+
+class HeartBeatSampleBank:
+    """
+    Decoding a heartbeat source spawns ffmpeg, so each source is decoded once per process and
+    its beats are sliced once, then shared by every bar, call and bpm.
+    Only the max_sources most recently used sources are kept.
+    """
+
+    DEFAULT_MAX_SOURCES = 4
+
+    def __init__(self, max_sources: int = DEFAULT_MAX_SOURCES):
+        self.max_sources = max_sources
+        self.sources = OrderedDict()
+
+    def get(self, filename: str, file_format: str = 'mp3', ranges: tuple = (HEART_BEAT_1_RANGE, HEART_BEAT_2_RANGE)):
+        """
+        :param ranges: (start, end) positions in ms of the beats to slice, None keeps the whole source as one beat
+        :return: a tuple of AudioSegment, heart_beat_1 and heart_beat_2 by default
+        """
+        key = (os.path.abspath(filename), file_format, ranges)
+        if key in self.sources:
+            self.sources.move_to_end(key)
+            return self.sources[key]
+
+        heart_beat_track = AudioSegment.from_file(file=filename, format=file_format)
+        if ranges is None:
+            heart_beats = (heart_beat_track,)
+        else:
+            heart_beats = tuple(heart_beat_track[start:end] for start, end in ranges)
+        self.sources[key] = heart_beats
+        if len(self.sources) > self.max_sources:
+            self.sources.popitem(last=False)
+        return heart_beats
+
+    def clear(self):
+        self.sources.clear()
+
+
+heart_beat_sample_bank = HeartBeatSampleBank()
+
+
+# one bar of heartbeat, as (offset in quarter notes, index of the heartbeat) pairs.
+# a quarter note contains 2 heart beats and one bar has two sets of them
+HEART_BEAT_BAR_PATTERN = [(0, 0), (0.5, 1), (2, 0), (2.5, 1)]
+BEATS_OF_ONE_BAR = 4
+SAMPLE_DTYPES = {1: numpy.int8, 2: numpy.int16, 4: numpy.int32}
+# raw sample formats given to the encoder
+ENCODER_SAMPLE_FORMATS = {1: 's8', 2: 's16le', 4: 's32le'}
+# frames converted and written at once when exporting
+EXPORT_CHUNK_FRAMES = 65536
+# frames mixed at once, in int64 before they are clipped to the sample type
+MIX_CHUNK_FRAMES = 65536
+
+
+def audio_segment_to_array(segment: AudioSegment):
+    """
+    :return: a float32 array of shape (frame count, channel count)
+    """
+    samples = numpy.array(segment.get_array_of_samples(), dtype=numpy.float32)
+    return samples.reshape((-1, segment.channels))
+
+
+def array_to_audio_segment(samples: numpy.ndarray, frame_rate: int, sample_width: int):
+    """
+    clip and convert a (frame count, channel count) array to an AudioSegment
+    """
+    return AudioSegment(data=to_sample_bytes(samples, sample_width), sample_width=sample_width,
+                        frame_rate=frame_rate, channels=samples.shape[1])
+
+
+def to_sample_bytes(samples: numpy.ndarray, sample_width: int):
+    dtype = SAMPLE_DTYPES[sample_width]
+    if samples.dtype == dtype:
+        return samples.tobytes()
+    info = numpy.iinfo(dtype)
+    return numpy.clip(samples, info.min, info.max).astype(dtype).tobytes()
+
+
+def heart_beat_offsets(bar_count: int, frames_per_beat: float):
+    """
+    :return: the frame offset of every beat of HEART_BEAT_BAR_PATTERN in bar_count bars,
+             an array of shape (bar count, pattern length)
+    """
+    bar_offsets = numpy.arange(bar_count) * BEATS_OF_ONE_BAR
+    pattern_offsets = numpy.array([offset for offset, _ in HEART_BEAT_BAR_PATTERN])
+    return numpy.round((bar_offsets[:, None] + pattern_offsets[None, :]) * frames_per_beat).astype(numpy.int64)
+
+
+def render_heart_beat_track(filename: str, bar_count: int, bpm: int, gain_db: float = 0):
+    """
+    render bar_count bars of heartbeat into a single preallocated buffer of the sample type of the source.
+    Each beat is placed at its sample accurate offset computed from bpm, so there is no drift over long tracks.
+    :return: a dict of samples (an integer array of shape (frame count, channel count)), frame_rate and sample_width
+    """
+    heart_beat_segments = heart_beat_sample_bank.get(filename)
+    frame_rate = heart_beat_segments[0].frame_rate
+    sample_width = heart_beat_segments[0].sample_width
+    heart_beats = [audio_segment_to_array(segment) for segment in heart_beat_segments]
+    channels = heart_beats[0].shape[1]
+
+    frames_per_beat = frame_rate * 60.0 / bpm
+    frame_count = int(round(bar_count * BEATS_OF_ONE_BAR * frames_per_beat))
+    # tile the pattern of one bar over every bar
+    pattern_beats = numpy.array([beat for _, beat in HEART_BEAT_BAR_PATTERN])
+    offsets = heart_beat_offsets(bar_count, frames_per_beat)
+    if bar_count > 0:
+        # a very high bpm may push the last beat out of the track
+        frame_count = max(frame_count, int(offsets.max()) + max(len(beat) for beat in heart_beats))
+
+    samples = numpy.zeros((frame_count, channels), dtype=SAMPLE_DTYPES[sample_width])
+    mix_at_offsets(samples, heart_beats, [offsets[:, pattern_beats == i].ravel() for i in range(len(heart_beats))],
+                   gain_db)
+    return dict(samples=samples, frame_rate=frame_rate, sample_width=sample_width)
+
+
+def render_heart_beat_at_ticks(filename: str, ticks: numpy.ndarray, tempo: int, ticks_per_quarternote: int,
+                               gain_db: float = 0):
+    """
+    render the whole filename sample at each of the given midi ticks into a single preallocated buffer
+    of the sample type of the source
+    :return: a dict of samples (an integer array of shape (frame count, channel count)), frame_rate and sample_width
+    """
+    heart_beat_segment = heart_beat_sample_bank.get(filename, ranges=None)[0]
+    frame_rate = heart_beat_segment.frame_rate
+    heart_beat = audio_segment_to_array(heart_beat_segment)
+
+    frames_per_tick = frame_rate * 60.0 / (tempo * ticks_per_quarternote)
+    offsets = numpy.round(numpy.asarray(ticks) * frames_per_tick).astype(numpy.int64)
+    frame_count = int(offsets.max()) + len(heart_beat) if len(offsets) > 0 else 0
+
+    samples = numpy.zeros((frame_count, heart_beat.shape[1]), dtype=SAMPLE_DTYPES[heart_beat_segment.sample_width])
+    mix_at_offsets(samples, [heart_beat], [offsets], gain_db)
+    return dict(samples=samples, frame_rate=frame_rate, sample_width=heart_beat_segment.sample_width)
+
+
+def mix_at_offsets(samples: numpy.ndarray, beats: List[numpy.ndarray], offsets: List[numpy.ndarray],
+                   gain_db: float = 0):
+    """
+    add each beat into the integer samples at every frame offset of it, in place, gain_db applied to the beats.
+    The track is mixed chunk by chunk in float32 and clipped once, so overlapping beats add up
+    without any temporary array of the size of the track.
+    """
+    info = numpy.iinfo(samples.dtype)
+    offsets = [numpy.sort(beat_offsets) for beat_offsets in offsets]
+    gain = numpy.float32(10 ** (gain_db / 20.0))
+    mixed = numpy.empty((MIX_CHUNK_FRAMES,) + samples.shape[1:], dtype=numpy.float32)
+    for start in range(0, len(samples), MIX_CHUNK_FRAMES):
+        end = min(start + MIX_CHUNK_FRAMES, len(samples))
+        chunk = mixed[:end - start]
+        chunk.fill(0)
+        for beat, beat_offsets in zip(beats, offsets):
+            # the beats sounding in the chunk
+            first, last = numpy.searchsorted(beat_offsets, [start - len(beat) + 1, end]).tolist()
+            for offset in beat_offsets[first:last].tolist():
+                low, high = max(offset, start), min(offset + len(beat), end)
+                chunk[low - start:high - start] += beat[low - offset:high - offset]
+        if gain_db != 0:
+            chunk *= gain
+            numpy.rint(chunk, out=chunk)
+        chunk += samples[start:end]
+        samples[start:end] = numpy.clip(chunk, info.min, info.max)
+
+
+def export_samples(samples: numpy.ndarray, frame_rate: int, sample_width: int, dest_filename: str,
+                   output_format: str = 'mp3'):
+    """
+    write a (frame count, channel count) sample array to dest_filename.
+    wav is written directly without any subprocess, other formats are encoded by ffmpeg.
+    Samples are converted chunk by chunk, so the whole track never exists twice in memory.
+    """
+    if output_format == 'wav':
+        write_wav(samples, frame_rate, sample_width, dest_filename)
+    else:
+        encode_samples(samples, frame_rate, sample_width, dest_filename, output_format)
+    print("====> file %s saved." % dest_filename)
+
+
+def write_wav(samples: numpy.ndarray, frame_rate: int, sample_width: int, dest_filename: str):
+    with wave.open(dest_filename, 'wb') as wav_file:
+        wav_file.setnchannels(samples.shape[1])
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(frame_rate)
+        for start in range(0, len(samples), EXPORT_CHUNK_FRAMES):
+            chunk = samples[start:start + EXPORT_CHUNK_FRAMES]
+            if sample_width == 1:
+                # 8 bits wav samples are unsigned
+                chunk = chunk.astype(numpy.int16) + 128
+                wav_file.writeframes(numpy.clip(chunk, 0, 255).astype(numpy.uint8).tobytes())
+            else:
+                wav_file.writeframes(to_sample_bytes(chunk, sample_width))
+
+
+def encode_samples(samples: numpy.ndarray, frame_rate: int, sample_width: int, dest_filename: str,
+                   output_format: str):
+    """
+    stream raw samples into the stdin of ffmpeg, which encodes them to output_format.
+    Its messages go to a temporary file, a pipe nobody reads while stdin is written could fill up and block both.
+    """
+    command = [get_encoder_name(), '-y', '-nostats', '-loglevel', 'error',
+               '-f', ENCODER_SAMPLE_FORMATS[sample_width], '-ar', str(frame_rate), '-ac', str(samples.shape[1]),
+               '-i', 'pipe:0', '-f', output_format, dest_filename]
+    with tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=error_file)
+        try:
+            for start in range(0, len(samples), EXPORT_CHUNK_FRAMES):
+                process.stdin.write(to_sample_bytes(samples[start:start + EXPORT_CHUNK_FRAMES], sample_width))
+        except BrokenPipeError:
+            # the encoder stopped early, its error is reported below
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        if process.wait() != 0:
+            error_file.seek(0)
+            raise Exception('Encoding of %s failed: %s' % (dest_filename,
+                                                           error_file.read().decode('utf-8', 'replace')))
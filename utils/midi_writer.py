@@ -0,0 +1,558 @@
+import shutil
+import struct
+import tempfile
+from typing import List
+
+import numpy
+from midiutil.MidiFile import TICKSPERQUARTERNOTE
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROLLER = 0xB0
+PROGRAM_CHANGE = 0xC0
+# status of meta events in the event arrays, they are never part of the running status
+META = -1
+
+# secondary sort order of events at the same tick, the same as MIDIUtil so that the output is the same
+SORT_TRACK_NAME = 0
+SORT_CONTROL = 1
+SORT_NOTE_OFF = 2
+SORT_NOTE_ON = 3
+SORT_TEMPO = 3
+
+END_OF_TRACK = b'\x00\xff\x2f\x00'
+# events of a track kept in memory by StreamingMIDIFile before they are written
+STREAMING_BUFFER_SIZE = 1 << 14
+
+NOTE_DTYPE = numpy.dtype([('tick', numpy.int64), ('duration', numpy.int64), ('channel', numpy.uint8),
+                          ('pitch', numpy.uint8), ('volume', numpy.uint8), ('order', numpy.int64)])
+# one row per written event, payload is the index of the bytes of a meta event
+EVENT_DTYPE = numpy.dtype([('tick', numpy.int64), ('sort', numpy.int64), ('order', numpy.int64),
+                           ('status', numpy.int64), ('data1', numpy.int64), ('data2', numpy.int64),
+                           ('data_length', numpy.int64), ('payload', numpy.int64)])
+
+
+def write_var_length(value: int):
+    """
+    MIDI variable length quantity of a single value
+    """
+    result = [value & 0x7f]
+    value >>= 7
+    while value > 0:
+        result.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes(result)
+
+
+def note_events(notes: numpy.ndarray, note_off: bool):
+    """
+    :return: the note on or the note off events of notes, as an EVENT_DTYPE array
+    """
+    events = numpy.empty(len(notes), dtype=EVENT_DTYPE)
+    if note_off:
+        events['tick'] = notes['tick'] + notes['duration']
+        events['sort'] = SORT_NOTE_OFF
+        events['status'] = NOTE_OFF | notes['channel'].astype(numpy.int64)
+    else:
+        events['tick'] = notes['tick']
+        events['sort'] = SORT_NOTE_ON
+        events['status'] = NOTE_ON | notes['channel'].astype(numpy.int64)
+    events['order'] = notes['order']
+    events['data1'] = notes['pitch']
+    events['data2'] = notes['volume']
+    events['data_length'] = 2
+    events['payload'] = -1
+    return events
+
+
+class ArrayMIDITrack:
+    """
+    Events of one track.
+    Notes are accumulated into numpy chunks, the few other events (track name, tempo, program change, controller)
+    stay in a python list.
+    """
+
+    def __init__(self):
+        self.note_chunks = []
+        # notes added one by one, turned into a chunk when the notes are read
+        self.pending_notes = []
+        self.events = []
+        self.event_keys = set([])
+        # whole bytes of the meta events, referenced by the payload column
+        self.payloads = []
+
+    def add_note(self, tick: int, duration: int, channel: int, pitch: int, volume: int, order: int):
+        self.pending_notes.append((tick, duration, channel, pitch, volume, order))
+
+    def add_note_chunk(self, chunk: numpy.ndarray):
+        self.__flush_pending_notes()
+        self.note_chunks.append(chunk)
+
+    def add_event(self, tick: int, sort: int, order: int, status: int, data: bytes, key: tuple = None):
+        """
+        :param status: status byte of a channel event, or META with the whole event in data
+        :param key: events with the same key are only written once, like MIDIUtil does
+        """
+        if key is not None:
+            if key in self.event_keys:
+                return
+            self.event_keys.add(key)
+        if status == META:
+            self.events.append((tick, sort, order, status, 0, 0, len(data), len(self.payloads)))
+            self.payloads.append(data)
+        else:
+            self.events.append((tick, sort, order, status, data[0], data[1] if len(data) > 1 else 0, len(data), -1))
+
+    def __flush_pending_notes(self):
+        if len(self.pending_notes) > 0:
+            self.note_chunks.append(numpy.array(self.pending_notes, dtype=NOTE_DTYPE))
+            self.pending_notes = []
+
+    def notes(self):
+        self.__flush_pending_notes()
+        if len(self.note_chunks) == 0:
+            return numpy.empty(0, dtype=NOTE_DTYPE)
+        if len(self.note_chunks) > 1:
+            self.note_chunks = [numpy.concatenate(self.note_chunks)]
+        return self.note_chunks[0]
+
+    def note_ticks(self, pitch: int):
+        """
+        :return: ticks of the note on events of the given pitch, in the order they were added
+        """
+        notes = self.notes()
+        return notes['tick'][notes['pitch'] == pitch]
+
+    def keep_note_ticks(self, pitch: int):
+        """
+        every note stays in memory, so note_ticks always works
+        """
+        pass
+
+    def event_table(self):
+        """
+        :return: every event added so far as an EVENT_DTYPE array, note on and note off events not deduplicated
+        """
+        notes = self.notes()
+        return numpy.concatenate((note_events(notes, False), note_events(notes, True),
+                                  numpy.array(self.events, dtype=EVENT_DTYPE)))
+
+    def clear(self):
+        """
+        forget the added events, the keys of the deduplicated events are kept
+        """
+        self.note_chunks = []
+        self.pending_notes = []
+        self.events = []
+
+    def encode(self, running_status: bool = True):
+        """
+        :return: the bytes of the MTrk chunk data, without the chunk header
+        """
+        events = sort_events(remove_duplicate_notes(self.event_table()))
+        events['tick'] = deinterleave_notes(events['tick'], events['status'], events['data1'])
+        # note off events may have been moved earlier
+        return encode_events(sort_events(events), self.payloads, running_status)
+
+
+class StreamingMIDITrack(ArrayMIDITrack):
+    """
+    An ArrayMIDITrack which writes its events to a temporary file once they can not change anymore.
+    Only the events not written yet stay in memory, and the notes still sounding for the note off correction.
+    :param buffer_size: number of added events kept in memory before they are written,
+                        so that short flushes do not pay the cost of the array operations each time
+    """
+
+    def __init__(self, temp_directory: str = None, buffer_size: int = STREAMING_BUFFER_SIZE):
+        super().__init__()
+        self.file = tempfile.TemporaryFile(dir=temp_directory)
+        self.buffer_size = buffer_size
+        # notes added since the last processing
+        self.added_notes = 0
+        self.size = 0
+        # events at or after the last boundary, their note on or note off may still be deduplicated
+        self.waiting = numpy.empty(0, dtype=EVENT_DTYPE)
+        # corrected events which may still be followed by a moved note off
+        self.processed = numpy.empty(0, dtype=EVENT_DTYPE)
+        self.stacks = {}
+        # no event may be added before it anymore
+        self.boundary = 0
+        # the events before it are processed
+        self.processed_boundary = 0
+        self.previous_tick = 0
+        self.previous_status = META
+        # by pitch given to keep_note_ticks, the ticks of its written note on events
+        self.kept_note_ticks = {}
+
+    def flush(self, boundary: int = None, running_status: bool = True):
+        """
+        write the events before the boundary tick once enough events are buffered,
+        no event may be added before it afterwards
+        :param boundary: None writes every event, at the end of the track
+        """
+        if boundary is not None:
+            self.boundary = max(self.boundary, boundary)
+            if self.added_count() < self.buffer_size:
+                return
+        boundary = None if boundary is None else self.boundary
+        notes = self.notes()
+        for pitch, chunks in self.kept_note_ticks.items():
+            chunks.append(notes['tick'][notes['pitch'] == pitch])
+        events = self.event_table()
+        self.clear()
+        self.added_notes = 0
+        if len(events) > 0 and events['tick'].min() < self.processed_boundary:
+            raise Exception('event at tick %d added after the track was flushed up to tick %d' %
+                            (events['tick'].min(), self.processed_boundary))
+        events = numpy.concatenate((self.waiting, events))
+        if boundary is None:
+            ready = numpy.ones(len(events), dtype=bool)
+        else:
+            ready = events['tick'] < boundary
+            self.processed_boundary = boundary
+        self.waiting = events[~ready]
+        events = sort_events(remove_duplicate_notes(events[ready]))
+        events['tick'] = deinterleave_notes(events['tick'], events['status'], events['data1'], self.stacks)
+        self.processed = sort_events(numpy.concatenate((self.processed, events)))
+
+        if boundary is None:
+            written = len(self.processed)
+        else:
+            # a note off can only be moved to a pending note on which is not the first of its stack
+            limit = min([boundary] + [min(stack[1:]) for stack in self.stacks.values() if len(stack) > 1])
+            written = int(numpy.searchsorted(self.processed['tick'], limit))
+        if written == 0:
+            return
+        events, self.processed = self.processed[:written], self.processed[written:]
+        data = encode_events(events, self.payloads, running_status, self.previous_tick, self.previous_status)
+        self.file.write(data)
+        self.size += len(data)
+        self.previous_tick = int(events['tick'][-1])
+        self.previous_status = int(events['status'][-1])
+
+    def add_note(self, tick: int, duration: int, channel: int, pitch: int, volume: int, order: int):
+        super().add_note(tick, duration, channel, pitch, volume, order)
+        self.added_notes += 1
+
+    def add_note_chunk(self, chunk: numpy.ndarray):
+        super().add_note_chunk(chunk)
+        self.added_notes += len(chunk)
+
+    def keep_note_ticks(self, pitch: int):
+        """
+        keep the ticks of the note on events of pitch once they are written, for note_ticks.
+        It must be called before the first notes are written.
+        """
+        if self.size > 0 or self.processed_boundary > 0:
+            raise Exception('note ticks of pitch %d must be kept before the track is flushed' % pitch)
+        self.kept_note_ticks.setdefault(pitch, [])
+
+    def note_ticks(self, pitch: int):
+        """
+        :return: ticks of the note on events of the given pitch, the written ones included
+        """
+        if pitch not in self.kept_note_ticks:
+            raise Exception('note ticks of pitch %d are not kept, see keep_note_ticks' % pitch)
+        return numpy.concatenate(self.kept_note_ticks[pitch] + [super().note_ticks(pitch)])
+
+    def added_count(self):
+        """
+        :return: number of events added since the last processing, a note makes two events
+        """
+        return 2 * self.added_notes + len(self.events)
+
+    def copy_to(self, fileHandle):
+        """
+        write the flushed events of the track to fileHandle and close the temporary file
+        """
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, fileHandle)
+        self.file.close()
+
+
+def sort_events(events: numpy.ndarray):
+    return events[numpy.lexsort((events['order'], events['sort'], events['tick']))]
+
+
+def remove_duplicate_notes(events: numpy.ndarray):
+    """
+    note on and note off events are deduplicated separately, as MIDIUtil does
+    """
+    is_note = (events['status'] >= 0) & ((events['status'] & 0xe0) == NOTE_OFF)
+    notes = events[is_note]
+    # the status tells the channel and whether it is a note on or a note off
+    unique = first_unique(notes['tick'], notes['data1'], notes['status'], notes['order'])
+    return numpy.concatenate((events[~is_note], notes[unique]))
+
+
+def first_unique(tick: numpy.ndarray, pitch: numpy.ndarray, channel: numpy.ndarray, order: numpy.ndarray):
+    """
+    :return: sorted indexes of the first inserted event of each (tick, pitch, channel)
+    """
+    index = numpy.lexsort((order, channel, pitch, tick))
+    duplicate = numpy.zeros(len(index), dtype=bool)
+    duplicate[1:] = ((tick[index][1:] == tick[index][:-1]) & (pitch[index][1:] == pitch[index][:-1]) &
+                     (channel[index][1:] == channel[index][:-1]))
+    return numpy.sort(index[~duplicate])
+
+
+def deinterleave_notes(tick: numpy.ndarray, status: numpy.ndarray, pitch: numpy.ndarray, stacks: dict = None):
+    """
+    same correction of overlapping notes of the same pitch as MIDIUtil: when a note off comes while several
+    note on of its pitch are pending, it is moved to the tick of the latest pending note on.
+    Only the pitches which actually overlap are replayed in python.
+    :param tick: event ticks, sorted
+    :param stacks: ticks of the pending note on by key, left by the events before these ones and updated in place
+    :return: the corrected ticks
+    """
+    is_note = (status >= 0) & ((status & 0xe0) == NOTE_OFF)
+    positions = numpy.flatnonzero(is_note)
+    if len(positions) == 0:
+        return tick
+    # the integer value of MIDIUtil's str(pitch) + str(channel) key, so that the same pitches collide
+    channel = status[positions] & 0x0f
+    key = pitch[positions] * numpy.where(channel < 10, 10, 100) + channel
+    delta = numpy.where((status[positions] & 0xf0) == NOTE_ON, 1, -1)
+    by_key = numpy.argsort(key, kind='stable')
+    sorted_key = key[by_key]
+    sorted_delta = delta[by_key]
+    pending = numpy.cumsum(sorted_delta)
+    # restart the count at each key
+    group_start = numpy.flatnonzero(numpy.concatenate(([True], sorted_key[1:] != sorted_key[:-1])))
+    group_size = numpy.diff(numpy.concatenate((group_start, [len(sorted_key)])))
+    group_key = sorted_key[group_start].tolist()
+    initial = numpy.zeros(len(group_start), dtype=numpy.int64)
+    if stacks:
+        initial = numpy.array([len(stacks.get(k, ())) for k in group_key], dtype=numpy.int64)
+    group_base = numpy.repeat(pending[group_start] - sorted_delta[group_start] - initial, group_size)
+    pending_before = pending - group_base - sorted_delta
+    # a note off without pending note on (its note on was a duplicate) makes the count wrong, replay it too
+    overlapping = ((sorted_delta < 0) & (pending_before > 1)) | (pending_before + sorted_delta < 0)
+    replayed = set(sorted_key[overlapping].tolist())
+    if stacks is not None:
+        group_end = group_start + group_size - 1
+        final = pending_before[group_end] + sorted_delta[group_end]
+        # the stack of more than one pending note on can only be known by the replay
+        replayed.update(k for k, count in zip(group_key, final.tolist()) if count > 1)
+        last_on = numpy.maximum.reduceat(numpy.where(sorted_delta > 0, numpy.arange(len(sorted_key)), -1),
+                                         group_start)
+        for k, count, last in zip(group_key, final.tolist(), last_on.tolist()):
+            if k in replayed:
+                continue
+            if count == 0:
+                stacks.pop(k, None)
+            elif last >= 0:
+                stacks[k] = [int(tick[positions[by_key[last]]])]
+    if len(replayed) == 0:
+        return tick
+
+    tick = tick.copy()
+    for overlapping_key in sorted(replayed):
+        stack = [] if stacks is None else stacks.get(overlapping_key, [])
+        for position in positions[by_key[sorted_key == overlapping_key]].tolist():
+            if (status[position] & 0xf0) == NOTE_ON:
+                stack.append(tick[position])
+            elif len(stack) > 1:
+                tick[position] = stack.pop()
+            elif len(stack) > 0:
+                stack.pop()
+        if stacks is not None:
+            stacks[overlapping_key] = stack
+    return tick
+
+
+def encode_events(events: numpy.ndarray, payloads: List[bytes], running_status: bool = True,
+                  previous_tick: int = 0, previous_status: int = META):
+    """
+    serialize sorted events in bulk: delta times, status bytes (omitted by running status) and data bytes.
+    :param payloads: whole bytes of the meta events, referenced by the payload column
+    :param previous_tick: tick of the event written just before, to chain several encodings of the same track
+    :param previous_status: status of the event written just before
+    :return: the bytes
+    """
+    count = len(events)
+    if count == 0:
+        return b''
+    tick, status, data_length = events['tick'], events['status'], events['data_length']
+    delta = numpy.diff(numpy.concatenate(([previous_tick], tick)))
+    var_length = (1 + (delta >= 1 << 7).astype(numpy.int64) + (delta >= 1 << 14).astype(numpy.int64) +
+                  (delta >= 1 << 21).astype(numpy.int64))
+    is_meta = status == META
+    status_length = numpy.where(is_meta, 0, 1)
+    if running_status:
+        # meta events cancel the running status
+        before = numpy.concatenate(([previous_status], status[:-1]))
+        status_length[(~is_meta) & (status == before)] = 0
+    size = var_length + status_length + data_length
+    offset = numpy.cumsum(size) - size
+    result = numpy.zeros(int(size.sum()), dtype=numpy.uint8)
+
+    for k in range(4):
+        has_byte = var_length > k
+        shift = 7 * (var_length[has_byte] - 1 - k)
+        continuation = numpy.where(var_length[has_byte] - 1 > k, 0x80, 0)
+        result[offset[has_byte] + k] = ((delta[has_byte] >> shift) & 0x7f) | continuation
+
+    position = offset + var_length
+    has_status = status_length > 0
+    result[position[has_status]] = status[has_status]
+    position = position + status_length
+    channel_event = ~is_meta
+    result[position[channel_event]] = events['data1'][channel_event]
+    two_data = channel_event & (data_length > 1)
+    result[position[two_data] + 1] = events['data2'][two_data]
+    for j in numpy.flatnonzero(is_meta).tolist():
+        payload = payloads[events['payload'][j]]
+        result[position[j]:position[j] + len(payload)] = numpy.frombuffer(payload, dtype=numpy.uint8)
+    return result.tobytes()
+
+
+class ArrayMIDIFile:
+    """
+    A replacement of MIDIUtil's MIDIFile for the calls used by Track.
+    Notes are kept in numpy arrays instead of event objects, sorted with a single lexsort and serialized in bulk.
+    With running_status=False, the output is byte identical to MIDIUtil, with it the output is only smaller.
+    Like MIDIUtil, event times are in quarter notes unless eventtime_is_ticks is set.
+    """
+
+    def __init__(self, numTracks: int = 1, file_format: int = 1,
+                 ticks_per_quarternote: int = TICKSPERQUARTERNOTE, running_status: bool = True,
+                 eventtime_is_ticks: bool = False):
+        self.file_format = file_format
+        if file_format == 1:
+            # tracks[0] is the tempo track
+            self.numTracks = numTracks + 1
+        else:
+            self.numTracks = numTracks
+        self.ticks_per_quarternote = ticks_per_quarternote
+        self.running_status = running_status
+        self.eventtime_is_ticks = eventtime_is_ticks
+        self.tracks = [self.create_track() for _ in range(self.numTracks)]
+        self.event_counter = 0
+        self.closed = False
+
+    def create_track(self):
+        return ArrayMIDITrack()
+
+    def time_to_ticks(self, time: float):
+        if self.eventtime_is_ticks:
+            return int(time)
+        return int(time * self.ticks_per_quarternote)
+
+    def __track(self, track: int):
+        if self.file_format == 1:
+            track += 1
+        return self.tracks[track]
+
+    def __next_order(self):
+        order = self.event_counter
+        self.event_counter += 1
+        return order
+
+    def addNote(self, track: int, channel: int, pitch: int, time: float, duration: float, volume: int,
+                annotation=None):
+        self.__track(track).add_note(self.time_to_ticks(time), self.time_to_ticks(duration), channel, pitch, volume,
+                                     self.__next_order())
+
+    def addNotes(self, track: int, channel: int, pitches: numpy.ndarray, ticks: numpy.ndarray,
+                 duration_ticks: numpy.ndarray, volumes: numpy.ndarray):
+        """
+        add many notes of one track at once, in the given order, times are always in ticks
+        """
+        count = len(pitches)
+        chunk = numpy.empty(count, dtype=NOTE_DTYPE)
+        chunk['tick'] = ticks
+        chunk['duration'] = duration_ticks
+        chunk['channel'] = channel
+        chunk['pitch'] = pitches
+        chunk['volume'] = volumes
+        chunk['order'] = numpy.arange(self.event_counter, self.event_counter + count)
+        self.event_counter += count
+        self.__track(track).add_note_chunk(chunk)
+
+    def addTempo(self, track: int, time: float, tempo: float):
+        tick = self.time_to_ticks(time)
+        value = int(60000000 / tempo)
+        data = b'\xff\x51\x03' + struct.pack('>L', value)[1:4]
+        # always on the tempo track of a format 1 file, and it does not count as an inserted event
+        target = self.tracks[0] if self.file_format == 1 else self.tracks[track]
+        target.add_event(tick, SORT_TEMPO, self.event_counter, META, data, key=('tempo', tick, value))
+
+    def addTrackName(self, track: int, time: float, trackName: str):
+        tick = self.time_to_ticks(time)
+        name = trackName.encode('ISO-8859-1')
+        data = b'\xff\x03' + write_var_length(len(name)) + name
+        self.__track(track).add_event(tick, SORT_TRACK_NAME, self.__next_order(), META, data,
+                                      key=('name', tick, name))
+
+    def addProgramChange(self, tracknum: int, channel: int, time: float, program: int):
+        tick = self.time_to_ticks(time)
+        self.__track(tracknum).add_event(tick, SORT_CONTROL, self.__next_order(), PROGRAM_CHANGE | channel,
+                                         bytes([program]), key=('program', tick, program, channel))
+
+    def addControllerEvent(self, track: int, channel: int, time: float, controller_number: int, parameter: int):
+        tick = self.time_to_ticks(time)
+        self.__track(track).add_event(tick, SORT_CONTROL, self.__next_order(), CONTROLLER | channel,
+                                      bytes([controller_number, parameter]))
+
+    def keep_note_ticks(self, track: int, pitch: int):
+        """
+        make get_note_ticks of this track and pitch work once its notes are written,
+        a StreamingMIDIFile only keeps the ticks asked for before it is flushed
+        """
+        self.__track(track).keep_note_ticks(pitch)
+
+    def get_note_ticks(self, track: int, pitch: int):
+        """
+        :return: ticks of the note on events of the given pitch in a track
+        """
+        return self.__track(track).note_ticks(pitch)
+
+    def writeFile(self, fileHandle):
+        fileHandle.write(b'MThd' + struct.pack('>LHHH', 6, self.file_format, self.numTracks,
+                                               self.ticks_per_quarternote))
+        for track in self.tracks:
+            data = track.encode(self.running_status) + END_OF_TRACK
+            fileHandle.write(b'MTrk' + struct.pack('>L', len(data)))
+            fileHandle.write(data)
+        self.closed = True
+
+
+class StreamingMIDIFile(ArrayMIDIFile):
+    """
+    An ArrayMIDIFile which keeps its tracks in temporary files instead of memory.
+    Calling flush(tick) once nothing will be added before tick anymore writes the events before it
+    as soon as a track buffered buffer_size events.
+    writeFile stitches the temporary files into the midi file in one pass.
+    get_note_ticks only works for the tracks and pitches given to keep_note_ticks before the first flush.
+    The output is the same as ArrayMIDIFile.
+    """
+
+    def __init__(self, numTracks: int = 1, file_format: int = 1,
+                 ticks_per_quarternote: int = TICKSPERQUARTERNOTE, running_status: bool = True,
+                 eventtime_is_ticks: bool = False, temp_directory: str = None,
+                 buffer_size: int = STREAMING_BUFFER_SIZE):
+        self.temp_directory = temp_directory
+        self.buffer_size = buffer_size
+        super().__init__(numTracks=numTracks, file_format=file_format, ticks_per_quarternote=ticks_per_quarternote,
+                         running_status=running_status, eventtime_is_ticks=eventtime_is_ticks)
+
+    def create_track(self):
+        return StreamingMIDITrack(self.temp_directory, self.buffer_size)
+
+    def flush(self, tick: int):
+        """
+        write the events before tick of every track to their temporary files
+        """
+        for track in self.tracks:
+            track.flush(tick, self.running_status)
+
+    def writeFile(self, fileHandle):
+        fileHandle.write(b'MThd' + struct.pack('>LHHH', 6, self.file_format, self.numTracks,
+                                               self.ticks_per_quarternote))
+        for track in self.tracks:
+            track.flush(None, self.running_status)
+            fileHandle.write(b'MTrk' + struct.pack('>L', track.size + len(END_OF_TRACK)))
+            track.copy_to(fileHandle)
+            fileHandle.write(END_OF_TRACK)
+        self.closed = True
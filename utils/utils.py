@@ -2,17 +2,31 @@ import os
 from typing import List
 
 import numpy
-from aubio import notes, source, pitch, tempo
+from aubio import notes, source, pitch, tempo, float_type
 from midiutil import MIDIFile
-from midiutil.MidiFile import TICKSPERQUARTERNOTE, NoteOn
+from midiutil.MidiFile import NoteOn
 from pydub import AudioSegment
 
 from model.channel import channel_map, CHANNEL_NAME_DRUM_KIT
 from model.note import Note, drum_map
+from model.pitch_track import PitchTrack
+from utils.cache import AnalysisCache
+from utils.heartbeat import heart_beat_sample_bank, render_heart_beat_track, array_to_audio_segment, \
+    export_samples, render_heart_beat_at_ticks
+from utils.midi_writer import ArrayMIDIFile, StreamingMIDIFile
 
 
-def create_midi_file(num_tracks: int, file_format: int):
-    return MIDIFile(numTracks=num_tracks, file_format=file_format)
+def create_midi_file(num_tracks: int, file_format: int, native: bool = False, streaming: bool = False):
+    """
+    event times of the created file are ticks, so that Track writes the integer timeline of the model as it is
+    :param native: use the numpy backed writer instead of MIDIUtil, much faster on long arrangements
+    :param streaming: the numpy backed writer keeping the tracks in temporary files, see Arrangement.iter_phrases
+    """
+    if streaming:
+        return StreamingMIDIFile(numTracks=num_tracks, file_format=file_format, eventtime_is_ticks=True)
+    if native:
+        return ArrayMIDIFile(numTracks=num_tracks, file_format=file_format, eventtime_is_ticks=True)
+    return MIDIFile(numTracks=num_tracks, file_format=file_format, eventtime_is_ticks=True)
 
 
 def save_midi_file(filename: str, midi_file: MIDIFile):
@@ -24,6 +38,15 @@ def save_midi_file(filename: str, midi_file: MIDIFile):
 DEFAULT_SAMPLE_RATE = 44100
 DOWN_SAMPLE = 1
 
+# parameters of the fused analysis, they are part of the analysis cache key
+NOTE_WIN_S = 512 // DOWN_SAMPLE  # fft size
+NOTE_HOP_S = 256 // DOWN_SAMPLE  # hop size
+PITCH_WIN_S = 4096 // DOWN_SAMPLE
+PITCH_HOP_S = 512 // DOWN_SAMPLE
+PITCH_TOLERANCE = 0.8
+TEMPO_WIN_S = 1024
+TEMPO_HOP_S = 512
+
 
 def read_note_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_RATE):
     """
@@ -87,23 +110,24 @@ def read_bpm_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_RAT
         if read < hop_s:
             break
 
-    def beats_to_bpm(beats, path):
-        # if enough beats are found, convert to periods then to bpm
-        if len(beats) > 1:
-            if len(beats) < 4:
-                print("few beats found in {:s}".format(path))
-            bpms = 60. / numpy.diff(beats)
-            return numpy.median(bpms)
-        else:
-            print("not enough beats found in {:s}".format(path))
-            return 0
-
     return beats_to_bpm(beats, filename)
 
 
+def beats_to_bpm(beats: List[float], path: str):
+    # if enough beats are found, convert to periods then to bpm
+    if len(beats) > 1:
+        if len(beats) < 4:
+            print("few beats found in {:s}".format(path))
+        bpms = 60. / numpy.diff(beats)
+        return numpy.median(bpms)
+    else:
+        print("not enough beats found in {:s}".format(path))
+        return 0
+
+
 def read_pitch_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_RATE):
     """
-    this method try to read pitches from a sound wave file with a list of dict of pitch and confidence
+    this method try to read pitches from a sound wave file with a PitchTrack of time, pitch and confidence
     """
     if os.path.isfile(filename) is False:
         raise Exception('File not found with filename = %s' % filename)
@@ -121,7 +145,7 @@ def read_pitch_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_R
     pitch_o.set_unit("midi")
     pitch_o.set_tolerance(tolerance)
 
-    result = []
+    result = PitchTrack()
 
     # total number of frames read
     total_frames = 0
@@ -130,17 +154,250 @@ def read_pitch_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_R
         # the pitch value is not rounded and many zeroes occur
         that_pitch = pitch_o(samples)[0]
         confidence = pitch_o.get_confidence()
-        result.append(dict(time=total_frames / float(samplerate), pitch=that_pitch, confidence=confidence))
+        result.append(total_frames / float(samplerate), that_pitch, confidence)
         total_frames += read
         if read < hop_s:
             break
 
-    group_result_with_log_density = compute_density_from_pitch_result(result)
-    density_level_list = compute_density_level(group_result_with_log_density, result[len(result) - 1]['time'])
+    return build_pitch_analysis(result)
+
+
+def build_pitch_analysis(result: PitchTrack):
+    """
+    compute density levels and emphasis proportions from the raw pitch frames
+    """
+    length = result[len(result) - 1]['time']
+    group_starts, group_ends, log_densities = compute_density_groups(result)
+    pitch_analysis = density_analysis(result.time[group_starts], result.time[group_ends - 1], log_densities, length)
+    pitch_analysis['pitch_result'] = result
+    return pitch_analysis
+
+
+def density_analysis(group_start_times: numpy.ndarray, group_end_times: numpy.ndarray,
+                     log_densities: numpy.ndarray, length: float):
+    """
+    build the density level list and the emphasis proportion list from the summaries of the density groups
+    """
+    levels, level_start_times = compute_density_level_array(group_start_times, log_densities, length)
+    density_level_list = [dict(level=level, start_time=start_time) for level, start_time in
+                          zip(levels.tolist(), level_start_times.tolist())]
     print("====> density level list length %s" % len(density_level_list))
-    proportion_list = get_emphasis_start_times(group_result_with_log_density, result[len(result) - 1]['time'])
+    starts, ends = get_emphasis_ranges(group_start_times, group_end_times, log_densities, length)
+    proportion_list = [dict(start=start, end=end) for start, end in zip(starts.tolist(), ends.tolist())]
     print("====> emphasis proportion list length = %d" % len(proportion_list))
-    return dict(pitch_result=result, emphasis_proportion_list=proportion_list, density_level_list=density_level_list)
+    return dict(emphasis_proportion_list=proportion_list, density_level_list=density_level_list)
+
+
+def analysis_parameters(samplerate: int = DEFAULT_SAMPLE_RATE):
+    """
+    every parameter which changes the result of read_analysis_from_sound_file
+    """
+    return dict(samplerate=samplerate, down_sample=DOWN_SAMPLE, note_win_s=NOTE_WIN_S, note_hop_s=NOTE_HOP_S,
+                pitch_win_s=PITCH_WIN_S, pitch_hop_s=PITCH_HOP_S, pitch_tolerance=PITCH_TOLERANCE,
+                tempo_win_s=TEMPO_WIN_S, tempo_hop_s=TEMPO_HOP_S)
+
+
+def read_analysis_from_sound_file(filename: str, samplerate: int = DEFAULT_SAMPLE_RATE, cache: AnalysisCache = None):
+    """
+    decode the sound file only once and feed the notes, pitch and tempo detectors from the same buffers.
+    It returns the same results as read_note_from_sound_file, read_pitch_from_sound_file
+    and read_bpm_from_sound_file, as a tuple of (note_result, pitch_result, bpm).
+    :param cache: when given, results are looked up and stored by file content and analysis parameters
+    """
+    if os.path.isfile(filename) is False:
+        raise Exception('File not found with filename = %s' % filename)
+
+    key = None
+    if cache is not None:
+        key = cache.key(filename, analysis_parameters(samplerate))
+        cached = cache.get(key)
+        if cached is not None:
+            print("====> analysis of %s loaded from cache" % filename)
+            return cached['note_result'], cached['pitch_result'], cached['bpm']
+
+    print("====> reading notes, pitch and bpm from sound file")
+    note_result = []
+    pitch_chunks = []
+    beats = []
+    for chunk in iter_analysis_chunks(filename, samplerate):
+        note_result.extend(chunk['notes'])
+        pitch_chunks.append(chunk['pitch'])
+        beats.extend(chunk['beats'])
+
+    pitch_result = build_pitch_analysis(PitchTrack.concatenate(pitch_chunks))
+    bpm = beats_to_bpm(beats, filename)
+    if cache is not None:
+        cache.put(key, dict(note_result=note_result, pitch_result=pitch_result, bpm=bpm))
+    return note_result, pitch_result, bpm
+
+
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def iter_analysis_chunks(filename: str, samplerate: int = DEFAULT_SAMPLE_RATE, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    a generator which decodes the sound file only once and feeds the notes, pitch and tempo detectors.
+    It yields dicts of notes (a list of Note), pitch (a PitchTrack) and beats (a list of beat times in second),
+    one every chunk_size pitch frames, so that nothing of the former chunks is kept.
+
+    The source is read with the smallest hop size (the notes one), the pitch and tempo detectors
+    accumulate consecutive hops until their own hop size is reached.
+    """
+    if os.path.isfile(filename) is False:
+        raise Exception('File not found with filename = %s' % filename)
+
+    note_win_s, note_hop_s = NOTE_WIN_S, NOTE_HOP_S
+    pitch_win_s, pitch_hop_s = PITCH_WIN_S, PITCH_HOP_S
+    tempo_win_s, tempo_hop_s = TEMPO_WIN_S, TEMPO_HOP_S
+    if pitch_hop_s % note_hop_s != 0 or tempo_hop_s % note_hop_s != 0:
+        raise Exception('hop sizes %d and %d must be multiples of %d' % (pitch_hop_s, tempo_hop_s, note_hop_s))
+
+    s = source(filename, samplerate, note_hop_s)
+    samplerate = s.samplerate
+
+    notes_o = notes("default", note_win_s, note_hop_s, samplerate)
+    pitch_o = pitch("yin", pitch_win_s, pitch_hop_s, samplerate)
+    pitch_o.set_unit("midi")
+    pitch_o.set_tolerance(PITCH_TOLERANCE)
+    tempo_o = tempo("phase", tempo_win_s, tempo_hop_s, samplerate)
+
+    note_result = []
+    pitch_frames = PitchTrack()
+    beats = []
+
+    # each detector owns a buffer of its hop size, filled hop by hop with the samples of the notes detector
+    pitch_buffer = numpy.zeros(pitch_hop_s, dtype=float_type)
+    tempo_buffer = numpy.zeros(tempo_hop_s, dtype=float_type)
+    pitch_filled = tempo_filled = 0
+    pitch_frames_read = 0
+    pitch_total_frames = 0
+    total_frames = 0
+    while True:
+        samples, read = s()
+        new_note = notes_o(samples)
+        # note too high considered as noise
+        if new_note[0] != 0 and new_note[0] <= 120:
+            note_klass = Note(time=total_frames / float(samplerate), pitch=new_note[0], volume=new_note[1] - 20,
+                              duration=new_note[2])
+            note_result.append(note_klass)
+        total_frames += read
+        is_last = read < note_hop_s
+
+        pitch_buffer[pitch_filled:pitch_filled + note_hop_s] = samples
+        pitch_filled += note_hop_s
+        pitch_frames_read += read
+        if pitch_filled == pitch_hop_s or is_last:
+            # a partial buffer is zero padded, exactly as the source does with its last hop
+            pitch_buffer[pitch_filled:] = 0
+            that_pitch = pitch_o(pitch_buffer)[0]
+            confidence = pitch_o.get_confidence()
+            pitch_frames.append(pitch_total_frames / float(samplerate), that_pitch, confidence)
+            pitch_total_frames += pitch_frames_read
+            pitch_filled = pitch_frames_read = 0
+
+        tempo_buffer[tempo_filled:tempo_filled + note_hop_s] = samples
+        tempo_filled += note_hop_s
+        if tempo_filled == tempo_hop_s or is_last:
+            tempo_buffer[tempo_filled:] = 0
+            if tempo_o(tempo_buffer):
+                beats.append(tempo_o.get_last_s())
+            tempo_filled = 0
+
+        if len(pitch_frames) >= chunk_size or is_last:
+            yield dict(notes=note_result, pitch=pitch_frames, beats=beats)
+            note_result = []
+            pitch_frames = PitchTrack()
+            beats = []
+
+        if is_last:
+            break
+
+
+class DensityAccumulator:
+    """
+    Maintain the density groups of compute_density_groups while pitch frames come chunk by chunk.
+    Only a summary of each closed group is kept: its start time, the time of its last frame and its frame count.
+    """
+
+    def __init__(self):
+        self.group_start_times = []
+        self.group_end_times = []
+        self.group_lengths = []
+        self.frame_count = 0
+        self.length = 0
+        # the first frame can never open a group
+        self.__last_voiced = True
+        self.__last_time = 0
+        self.__group_start = 0
+        self.__group_start_time = 0
+
+    def feed(self, pitch_chunk: PitchTrack):
+        if len(pitch_chunk) == 0:
+            return
+        time = pitch_chunk.time
+        voiced = numpy.round(pitch_chunk.pitch) != 0
+        previous_voiced = numpy.concatenate(([self.__last_voiced], voiced[:-1]))
+        boundaries = numpy.flatnonzero(voiced & ~previous_voiced)
+        if len(boundaries) > 0:
+            bounds = numpy.concatenate(([self.__group_start], boundaries + self.frame_count))
+            start_times = numpy.concatenate(([self.__group_start_time], time[boundaries[:-1]]))
+            # the last frame of a group may belong to the former chunk
+            end_times = numpy.where(boundaries > 0, time[numpy.maximum(boundaries - 1, 0)], self.__last_time)
+            self.group_start_times.extend(start_times.tolist())
+            self.group_end_times.extend(end_times.tolist())
+            self.group_lengths.extend(numpy.diff(bounds).tolist())
+            self.__group_start = int(bounds[-1])
+            self.__group_start_time = float(time[boundaries[-1]])
+
+        self.__last_voiced = bool(voiced[-1])
+        self.__last_time = float(time[-1])
+        self.frame_count += len(pitch_chunk)
+        self.length = self.__last_time
+
+    def result(self):
+        """
+        same density_level_list and emphasis_proportion_list as build_pitch_analysis
+        """
+        return density_analysis(numpy.array(self.group_start_times), numpy.array(self.group_end_times),
+                                numpy.log10(self.group_lengths), self.length)
+
+
+class StreamingAnalysis:
+    """
+    Streaming version of read_analysis_from_sound_file for arbitrarily long recordings.
+    Iterating over it yields the chunks of iter_analysis_chunks, while density groups and beats are
+    summarised incrementally. Once the iteration is over, result() gives the pitch analysis
+    (without pitch_result) and the bpm.
+
+    for chunk in analysis:
+        handle(chunk['notes'])
+    analysis.result()
+    """
+
+    def __init__(self, filename: str, samplerate: int = DEFAULT_SAMPLE_RATE, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.filename = filename
+        self.samplerate = samplerate
+        self.chunk_size = chunk_size
+        self.density = DensityAccumulator()
+        # a beat every half second or so, compact enough to keep for the median.
+        # the beats of each chunk, concatenated once by result()
+        self.beat_chunks = []
+        self.finished = False
+
+    def __iter__(self):
+        for chunk in iter_analysis_chunks(self.filename, self.samplerate, self.chunk_size):
+            self.density.feed(chunk['pitch'])
+            self.beat_chunks.append(chunk['beats'])
+            yield chunk
+        self.finished = True
+
+    def result(self):
+        if self.finished is False:
+            raise Exception('the analysis of %s has not been read until the end' % self.filename)
+        pitch_analysis = self.density.result()
+        beats = numpy.concatenate([numpy.empty(0)] + self.beat_chunks)
+        pitch_analysis['bpm'] = beats_to_bpm(beats, self.filename)
+        return pitch_analysis
 
 
 def compute_density_level(group_result_with_log_density: List[dict], length: float):
@@ -171,16 +428,20 @@ def compute_density_level(group_result_with_log_density: List[dict], length: flo
     return level_list
 
 
-def compute_density_from_pitch_result(pitch_result: List[dict]):
+def compute_density_from_pitch_result(pitch_result: PitchTrack):
+    """
+    split the pitch frames into groups, a group starts when a pitch is voiced after an unvoiced one.
+    Each group is a PitchTrack view of the frames, nothing is copied.
+    """
+    pitches = pitch_result.pitch
     group_result = []
-    group = []
-    for i, pitch_dict in enumerate(pitch_result):
+    group_start = 0
+    for i in range(1, len(pitch_result)):
         # current is not zero, but previous is zero
         # should flush the group
-        if round(pitch_dict['pitch']) != 0 and i - 1 >= 0 and round(pitch_result[i - 1]['pitch']) == 0:
-            group_result.append(group)
-            group = []
-        group.append(pitch_dict)
+        if round(pitches[i]) != 0 and round(pitches[i - 1]) == 0:
+            group_result.append(pitch_result[group_start:i])
+            group_start = i
 
     # now for each group we have the elements which are essentially divided by time frame
     # we just need to identify the average density and get the highest ones
@@ -229,34 +490,97 @@ def get_emphasis_start_times(group_result_with_log_density: List[dict], length:
     return proportion_list
 
 
-def drum_note_to_heart_beat_track(midi_instance: MIDIFile):
-    """
-    @Deprecated
-    """
-    # exporting bass drum notes
-    bass_drum_beats_in_ms = []
-    ms_per_tick = 60 * 1000 / (tempo * TICKSPERQUARTERNOTE)
-    for event in midi_instance.tracks[channel_map[CHANNEL_NAME_DRUM_KIT]].eventList:
-        if isinstance(event, NoteOn) and event.pitch == drum_map['BassDrum']:
-            bass_drum_beats_in_ms.append(ms_per_tick * event.tick)
-    single_heart_beat = AudioSegment.from_file('./single_heartbeat.mp3', format='mp3')
-    heartbeat_track = AudioSegment.empty()
-    for i, bass_drum_beat_note_on in enumerate(bass_drum_beats_in_ms):
-        if i == 0:
-            heartbeat_track += AudioSegment.silent(duration=bass_drum_beat_note_on)
-        elif i + 1 < len(bass_drum_beats_in_ms):
-            # if the next bass drum time is early than heartbeat track
-            if len(heartbeat_track) > bass_drum_beats_in_ms[i + 1]:
-                continue
-            # fill the gap till the next heart beat
-            gap = bass_drum_beats_in_ms[i + 1] - len(heartbeat_track)
-            heartbeat_track += AudioSegment.silent(duration=gap)
-        elif i == len(bass_drum_beats_in_ms) - 1:
-            # ignore the last one
-            continue
-        heartbeat_track += single_heart_beat
-
-    heartbeat_track.export('heartbeat_track.mp3', format='mp3')
+def compute_density_groups(pitch_result: PitchTrack):
+    """
+    vectorized version of compute_density_from_pitch_result.
+    Group boundaries are the zero crossings of the rounded pitch, as before the frames after the last boundary
+    do not make a group.
+    :return: arrays of group start indexes, group end indexes (exclusive) and group log densities
+    """
+    voiced = numpy.round(pitch_result.pitch) != 0
+    # current is not zero, but previous is zero
+    boundaries = numpy.flatnonzero(voiced[1:] & ~voiced[:-1]) + 1
+    bounds = numpy.concatenate(([0], boundaries))
+    log_densities = numpy.log10(numpy.diff(bounds))
+    return bounds[:-1], bounds[1:], log_densities
+
+
+def compute_density_level_array(group_start_times: numpy.ndarray, log_densities: numpy.ndarray, length: float):
+    """
+    vectorized version of compute_density_level
+    :param group_start_times: time of the first frame of each group
+    :param length end time
+    :return: arrays of levels (from 0 to 9) and relative start times of the groups
+    """
+    min_val = log_densities.min()
+    # split range with 10 and compute which to where
+    gap = (log_densities.max() - min_val) / 9
+    if gap != 0:
+        levels = numpy.round((log_densities - min_val) / gap).astype(int)
+    else:
+        levels = numpy.full(len(log_densities), 5, dtype=int)
+    return levels, group_start_times.astype(numpy.float64) / length
+
+
+def get_emphasis_ranges(group_start_times: numpy.ndarray, group_end_times: numpy.ndarray,
+                        log_densities: numpy.ndarray, length: float, coefficient: int = 0.8, threshold: int = 1):
+    """
+    vectorized version of get_emphasis_start_times
+    :param group_start_times: time of the first frame of each group
+    :param group_end_times: time of the last frame of each group
+    :return: arrays of relative start and end times of the emphasis groups
+    """
+    filter_value = coefficient * log_densities.max()
+    emphasis = (log_densities >= threshold) & (log_densities >= filter_value)
+    return (group_start_times[emphasis].astype(numpy.float64) / length,
+            group_end_times[emphasis].astype(numpy.float64) / length)
+
+
+def drum_kit_track():
+    # tracks are created in the order of channel_map, see Track.create_track_map
+    return list(channel_map.keys()).index(CHANNEL_NAME_DRUM_KIT)
+
+
+def keep_drum_note_ticks(midi_instance: MIDIFile, drum_name: str = 'BassDrum'):
+    """
+    a streaming midi file only keeps the note ticks it is asked for,
+    call it before the file is flushed to use get_drum_note_ticks later
+    """
+    if isinstance(midi_instance, ArrayMIDIFile):
+        midi_instance.keep_note_ticks(drum_kit_track(), drum_map[drum_name])
+
+
+def get_drum_note_ticks(midi_instance: MIDIFile, drum_name: str = 'BassDrum'):
+    """
+    sorted unique ticks of the NoteOn events of one drum in the drum kit track.
+    It must be called before the file is saved, since writing turns the event ticks into relative ones.
+    With a streaming midi file, see keep_drum_note_ticks.
+    """
+    if midi_instance.closed:
+        raise Exception('Unable to read drum notes of a midi file already written')
+    track = drum_kit_track()
+    pitch = drum_map[drum_name]
+    if isinstance(midi_instance, ArrayMIDIFile):
+        return numpy.unique(midi_instance.get_note_ticks(track, pitch))
+    if midi_instance.header.numeric_format == 1:
+        # tracks[0] is the tempo track
+        track += 1
+    ticks = [event.tick for event in midi_instance.tracks[track].eventList
+             if isinstance(event, NoteOn) and event.pitch == pitch]
+    return numpy.unique(numpy.array(ticks, dtype=numpy.int64))
+
+
+def drum_note_to_heart_beat_track(midi_instance: MIDIFile, tempo: int, dest_filename: str = 'heartbeat_track.mp3',
+                                  filename: str = './single_heartbeat.mp3', output_format: str = 'mp3'):
+    """
+    make the heartbeat follow the drum arrangement: a heartbeat sample is mixed at every bass drum note.
+    Beats close to each other overlap instead of being skipped.
+    """
+    ticks = get_drum_note_ticks(midi_instance)
+    print("====> %d bass drum notes to heartbeat" % len(ticks))
+    rendered = render_heart_beat_at_ticks(filename, ticks, tempo, midi_instance.ticks_per_quarternote)
+    export_samples(rendered['samples'], rendered['frame_rate'], rendered['sample_width'], dest_filename,
+                   output_format=output_format)
 
 
 def get_one_bar_heart_beat(filename: str, bpm: int):
@@ -266,10 +590,8 @@ def get_one_bar_heart_beat(filename: str, bpm: int):
     which is undetermined yet.
     :return:
     """
-    heart_beat_track = AudioSegment.from_file(file=filename, format='mp3')
-    heart_beat_1 = heart_beat_track[70:180]
-    heart_beat_2 = heart_beat_track[380:490]
-    # AudioSegment.export(part, 'single_heartbeat1.mp3')
+    # decoded only once per process
+    heart_beat_1, heart_beat_2 = heart_beat_sample_bank.get(filename)
 
     tick_per_sec = 60 * 1000 / bpm
 
@@ -299,23 +621,26 @@ def get_one_bar_heart_beat(filename: str, bpm: int):
     return result_track
 
 
-def get_heart_beat_track(filename: str, bar_count: int, bpm: int):
-    result = AudioSegment.empty()
-    for i in range(bar_count):
-        result += get_one_bar_heart_beat(filename, bpm)
-    return result
+def get_heart_beat_track(filename: str, bar_count: int, bpm: int, gain_db: float = 0):
+    rendered = render_heart_beat_track(filename, bar_count, bpm, gain_db=gain_db)
+    return array_to_audio_segment(rendered['samples'], rendered['frame_rate'], rendered['sample_width'])
 
 
-def get_heart_beat_track_and_save(filename: str, dest_filename: str, bar_count: int, bpm: int):
-    result = get_heart_beat_track(filename, bar_count, bpm)
+def get_heart_beat_track_and_save(filename: str, dest_filename: str, bar_count: int, bpm: int,
+                                  output_format: str = 'mp3'):
+    """
+    :param output_format: wav is written directly from the samples, other formats like mp3 or flac
+    are streamed to ffmpeg
+    """
     # reduce 3dB of the result
-    result = result - 3
+    rendered = render_heart_beat_track(filename, bar_count, bpm, gain_db=-3)
 
     # tick_per_sec = 60 * 1000 / bpm
     # fade_time = round(tick_per_sec * 4)
     # result.fade_in(fade_time)
     # result.fade_out(fade_time)
-    AudioSegment.export(result, dest_filename)
+    export_samples(rendered['samples'], rendered['frame_rate'], rendered['sample_width'], dest_filename,
+                   output_format=output_format)
 
 
 REF_BPM = 90